@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2023 Alan de Freitas (alandefreitas@gmail.com)
+#
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE_1_0.txt or copy at http://www.boost.org/LICENSE_1_0.txt)
+#
+# Official repository: https://github.com/alandefreitas/cpp-actions
+#
+
+# Benchmarks scan_deps.py on a synthetic source tree.
+#
+# The tree has project headers under include/ nested a few directories deep,
+# and sources under src/ and test/. Each file has some filler code, includes
+# a few boost headers from synthetic modules, and includes project headers
+# so the include graph can be followed. A synthetic index is written next to
+# the tree, so the benchmark never needs the network.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import scan_deps
+
+
+def generate_tree(dir, files, density, depth, lines, modules, seed):
+    rng = random.Random(seed)
+    module_names = ['mod{}'.format(i) for i in range(modules)]
+    filler = 'int value_{0} = {0}; // filler code that does not include anything\n'
+
+    # Project headers nested depth directories deep
+    n_headers = max(1, files // 3)
+    headers = []
+    for i in range(n_headers):
+        subdir = '/'.join('d{}'.format((i >> (2 * level)) % 4) for level in range(depth))
+        headers.append('proj/{}/h{}.hpp'.format(subdir, i) if subdir else 'proj/h{}.hpp'.format(i))
+
+    def write_file(path, project_includes):
+        path = os.path.join(dir, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            for h in project_includes:
+                f.write('#include <{}>\n'.format(h))
+            for i in range(lines):
+                if density and i % max(1, lines // density) == 0:
+                    m = rng.choice(module_names)
+                    f.write('#include <boost/{}/h{}.hpp>\n'.format(m, rng.randrange(10)))
+                else:
+                    f.write(filler.format(i))
+
+    for i, h in enumerate(headers):
+        # Headers only include headers generated before them, so the graph has no cycles
+        write_file(os.path.join('include', h), [headers[j] for j in rng.sample(range(i), min(i, 2))])
+    n_sources = max(1, files - n_headers)
+    for i in range(n_sources):
+        subdir = 'src' if i % 2 == 0 else 'test'
+        write_file(os.path.join(subdir, 'source{}.cpp'.format(i)), rng.sample(headers, min(len(headers), 3)))
+
+    # Index with the synthetic modules
+    index = {
+        'version': 1,
+        'branch': 'bench',
+        'exceptions': {},
+        'modules': module_names,
+        'dependencies': dict((m, module_names[:i]) for i, m in enumerate(module_names))
+    }
+    index_path = os.path.join(dir, 'bench.index.json')
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    return index_path
+
+
+def tree_size(dir):
+    n = 0
+    size = 0
+    for root, dirs, files in os.walk(dir):
+        for file in files:
+            if file.endswith('.hpp') or file.endswith('.cpp'):
+                n += 1
+                size += os.path.getsize(os.path.join(root, file))
+    return n, size
+
+
+def run(name, func, n_files, size, repeat, setup=None):
+    best = None
+    modules = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        modules = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    best = max(best, 1e-9)
+    print('| {} | {:.3f} s | {:.0f} | {:.1f} | {} |'.format(
+        name, best, n_files / best, size / best / (1024 * 1024), len([m for m in modules if m])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks scan_deps.py on a synthetic source tree.')
+    parser.add_argument('--files', help="number of files in the tree", type=int, default=2000)
+    parser.add_argument('--density', help="boost includes per file", type=int, default=5)
+    parser.add_argument('--depth', help="directory depth of the project headers", type=int, default=3)
+    parser.add_argument('--lines', help="lines of code per file", type=int, default=200)
+    parser.add_argument('--modules', help="number of synthetic boost modules", type=int, default=50)
+    parser.add_argument('-j', '--jobs', help="processes for the parallel mode; 0 uses all available cores",
+                        type=int, default=0)
+    parser.add_argument('--repeat', help="runs of each mode; the best time is reported", type=int, default=3)
+    parser.add_argument('--seed', help="random seed for the tree", type=int, default=0)
+    parser.add_argument('--dir', help="directory for the tree (default: a temporary directory)", default='')
+    parser.add_argument('--keep', help="keep the generated tree", action='store_true')
+    args = parser.parse_args()
+
+    dir = args.dir or tempfile.mkdtemp(prefix='scan_deps_bench_')
+    try:
+        start = time.time()
+        index_path = generate_tree(dir, args.files, args.density, args.depth, args.lines, args.modules, args.seed)
+        n_files, size = tree_size(dir)
+        print('Generated {} files ({:.1f} MB) in {} in {:.2f} s\n'.format(
+            n_files, size / (1024 * 1024), dir, time.time() - start))
+
+        scanner = scan_deps.Scanner('bench', index_path)
+        jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+        cache_path = os.path.join(dir, 'scan-cache.json')
+        sources = [os.path.relpath(os.path.join(dir, 'src', f), dir) for f in os.listdir(os.path.join(dir, 'src'))]
+        sources += [os.path.relpath(os.path.join(dir, 'test', f), dir) for f in os.listdir(os.path.join(dir, 'test'))]
+
+        def cold_cache():
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+            cache = scan_deps.ScanCache(cache_path)
+            modules = scanner.scan(dir, cache=cache)
+            cache.save()
+            return modules
+
+        def warm_cache():
+            cache = scan_deps.ScanCache(cache_path)
+            modules = scanner.scan(dir, cache=cache)
+            cache.save()
+            return modules
+
+        # The tree is committed to a git repository so a fresh checkout can be cloned from it
+        checkout_dir = dir.rstrip(os.sep) + '_checkout'
+        for command in (['init', '-q'], ['add', '-A'],
+                        ['-c', 'user.name=bench', '-c', 'user.email=bench@example.com', 'commit', '-q', '-m', 'tree']):
+            subprocess.check_call(['git', '-C', dir] + command)
+
+        def fresh_checkout():
+            # A fresh checkout, as in CI, gives all files new modification times
+            if os.path.exists(checkout_dir):
+                shutil.rmtree(checkout_dir)
+            subprocess.check_call(['git', 'clone', '-q', dir, checkout_dir])
+            # Files written in the same timestamp tick as the index are racy. A checkout of this size finishes
+            # within a few ticks, so refresh the index as git does once the racy entries are verified.
+            time.sleep(0.05)
+            subprocess.check_call(['git', '-C', checkout_dir, 'update-index', '-q', '--refresh'])
+
+        def touch_files():
+            # Modification times that no longer match the git index, so the cache reads the files
+            fresh_checkout()
+            now = time.time() + 1
+            for root, _, files in os.walk(checkout_dir):
+                for file in files:
+                    os.utime(os.path.join(root, file), (now, now))
+
+        def checkout_cache(scanner, cache_path):
+            cache = scan_deps.ScanCache(cache_path, scanner.preprocessor.settings() if scanner.preprocessor else None)
+            modules = scanner.scan(checkout_dir, cache=cache)
+            cache.save()
+            return modules
+
+        print('| Mode | Time | Files/s | MB/s | Modules |')
+        print('| ---- | ---- | ------- | ---- | ------- |')
+        run('serial', lambda: scanner.scan(dir), n_files, size, args.repeat)
+        run('jobs={}'.format(jobs), lambda: scanner.scan(dir, jobs=jobs), n_files, size, args.repeat)
+        run('mmap', lambda: scanner.scan(dir, mmap_threshold=1), n_files, size, args.repeat)
+        run('cache (cold)', cold_cache, n_files, size, args.repeat)
+        run('cache (warm)', warm_cache, n_files, size, args.repeat)
+        run('cache (fresh checkout)', lambda: checkout_cache(scanner, cache_path), n_files, size, args.repeat,
+            fresh_checkout)
+        run('cache (touched files)', lambda: checkout_cache(scanner, cache_path), n_files, size, args.repeat,
+            touch_files)
+        run('follow', lambda: scanner.follow(dir, sources), n_files, size, args.repeat)
+        preprocessing_scanner = scan_deps.Scanner('bench', index_path, preprocessor=scan_deps.Preprocessor())
+        run('preprocess', lambda: preprocessing_scanner.scan(dir), n_files, size, args.repeat)
+        preprocess_cache_path = os.path.join(dir, 'preprocess-scan-cache.json')
+        cache = scan_deps.ScanCache(preprocess_cache_path, preprocessing_scanner.preprocessor.settings())
+        preprocessing_scanner.scan(dir, cache=cache)
+        cache.save()
+        run('preprocess + cache (fresh checkout)', lambda: checkout_cache(preprocessing_scanner, preprocess_cache_path),
+            n_files, size, args.repeat, fresh_checkout)
+    finally:
+        if os.path.exists(checkout_dir):
+            shutil.rmtree(checkout_dir)
+        if not args.keep and not args.dir:
+            shutil.rmtree(dir)
@@ -35,9 +35,24 @@ import re
 import sys
 import os
 import argparse
+import hashlib
+import json
+import shlex
+import fnmatch
+import functools
+import mmap
+import subprocess
+from bisect import bisect_right
+import time
 
 verbose = 0
 
+# Directory with the <branch>.* data files
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Subdirectories scanned by default
+default_subdirs = ['include', 'src', 'source', 'test', 'tests', 'example', 'examples']
+
 
 def vprint(level, *args):
     if verbose >= level:
@@ -45,89 +60,869 @@ def vprint(level, *args):
 
 
 def is_module(m, gm):
-    return ('libs/' + m) in gm
+    return m in gm
+
+
+def submodule_index(submodule_paths):
+    # Set of module names (such as "numeric/conversion") from the .gitmodules paths
+    return set(p[len('libs/'):] for p in submodule_paths if p.startswith('libs/'))
+
+
+# Patterns used to infer the module of headers not listed in exceptions.txt
+module_header_patterns = [
+    # boost/function.hpp
+    re.compile('boost/([^\\./]*)\\.h[a-z]*$'),
+    # boost/numeric/conversion.hpp
+    re.compile('boost/([^/]*/[^\\./]*)\\.h[a-z]*$'),
+    # boost/numeric/conversion/header.hpp
+    re.compile('boost/([^/]*/[^/]*)/'),
+    # boost/function/header.hpp
+    re.compile('boost/([^/]*)/')]
+
+# Matches the boost header in an include directive anywhere in a file buffer.
+# The patterns start at the "#" rather than at the beginning of the line so the regex engine
+# can skip ahead to each "#" instead of trying a match at every line. is_directive checks
+# the rest of the line is blank.
+include_pattern = re.compile(b'#[ \t]*include[ \t]*["<](boost/[^">\r\n]*)[">]')
+
+# Matches the delimiter and header of any include directive
+any_include_pattern = re.compile(b'#[ \t]*include[ \t]*([<"])([^">\r\n]*)[">]')
+
+
+def is_directive(contents, pos):
+    # Whether only blanks precede the "#" at pos in its line
+    line_start = contents.rfind(b'\n', 0, pos) + 1
+    return not contents[line_start:pos].strip(b' \t')
 
 
 def module_for_header(h, x, gm):
     if h in x:
         return x[h]
     else:
-        # boost/function.hpp
-        m = re.match('boost/([^\\./]*)\\.h[a-z]*$', h)
+        for pattern in module_header_patterns:
+            m = pattern.match(h)
 
-        if m and is_module(m.group(1), gm):
-            return m.group(1)
+            if m and is_module(m.group(1), gm):
+                return m.group(1)
 
-        # boost/numeric/conversion.hpp
-        m = re.match('boost/([^/]*/[^\\./]*)\\.h[a-z]*$', h)
+        vprint(1, 'Cannot determine module for header', h)
 
-        if m and is_module(m.group(1), gm):
-            return m.group(1)
+        return None
 
-        # boost/numeric/conversion/header.hpp
-        m = re.match('boost/([^/]*/[^/]*)/', h)
 
-        if m and is_module(m.group(1), gm):
-            return m.group(1)
+class ModuleResolver:
+    """Resolves boost headers to modules, remembering each header already resolved."""
 
-        # boost/function/header.hpp
-        m = re.match('boost/([^/]*)/', h)
+    def __init__(self, exceptions, modules):
+        self.exceptions = exceptions
+        self.modules = set(modules)
+        self.cache = {}
 
-        if m and is_module(m.group(1), gm):
-            return m.group(1)
+    def __call__(self, h):
+        if h in self.cache:
+            return self.cache[h]
+        mod = module_for_header(h, self.exceptions, self.modules)
+        self.cache[h] = mod
+        return mod
+
+
+# Matches the conditional, include and define directives the preprocessor evaluates, including
+# lines continued with a backslash
+directive_pattern = re.compile(
+    br'#[ \t]*(if|ifdef|ifndef|elif|elifdef|elifndef|else|endif|include|define|undef)\b((?:\\\r?\n|[^\r\n])*)')
+
+# Comments and literals, so a block comment is only recognized where it starts outside of them
+comment_pattern = re.compile(br'//[^\n]*|/\*.*?(?:\*/|\Z)|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'', re.DOTALL)
+
+
+def block_comments(contents):
+    # Sorted (start, end) positions of the block comments in contents
+    comments = []
+    if contents.find(b'/*') == -1:
+        return comments
+    for m in comment_pattern.finditer(contents):
+        if contents[m.start():m.start() + 2] == b'/*':
+            comments.append((m.start(), m.end()))
+    return comments
+
+
+# Tokens of a conditional expression: numbers, identifiers and operators
+expression_token_pattern = re.compile(
+    r'\s*(?:(\d[\w.\']*)|([A-Za-z_]\w*)|(&&|\|\||<<|>>|<=|>=|==|!=|[-+*/%<>&^|!~?:(),]))')
+
+# Precedence of the binary operators in conditional expressions
+binary_precedence = {
+    '||': 1, '&&': 2, '|': 3, '^': 4, '&': 5, '==': 6, '!=': 6, '<': 7, '>': 7, '<=': 7, '>=': 7,
+    '<<': 8, '>>': 8, '+': 9, '-': 9, '*': 10, '/': 10, '%': 10}
 
-        vprint(1, 'Cannot determine module for header', h)
 
+def is_true(v):
+    return v is not None and v != 0
+
+
+def is_false(v):
+    return v is not None and v == 0
+
+
+class ConditionalExpression:
+    """Evaluates a preprocessor conditional expression to an integer, or None when its value is unknown.
+
+    Unknown macros, function-like macros and unsupported constructs evaluate to None, and
+    None propagates through operators unless the result does not depend on it, as in
+    "0 && X" or "1 || X"."""
+
+    def __init__(self, text, lookup, defined):
+        self.tokens = []
+        pos = 0
+        text = text.strip()
+        while pos < len(text):
+            m = expression_token_pattern.match(text, pos)
+            if not m:
+                raise ValueError('Unsupported token in ' + text)
+            self.tokens.append((m.group(1), m.group(2), m.group(3)))
+            pos = m.end()
+        self.pos = 0
+        self.lookup = lookup
+        self.defined = defined
+
+    def evaluate(self):
+        v = self.ternary()
+        if self.pos != len(self.tokens):
+            raise ValueError('Unexpected token')
+        return v
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][2]
         return None
 
+    def next(self):
+        if self.pos >= len(self.tokens):
+            raise ValueError('Unexpected end of expression')
+        self.pos += 1
+        return self.tokens[self.pos - 1]
 
-def scan_header_dependencies(f, exceptions, submodule_paths):
-    deps = set()
-    for line in f:
-        m = re.match('[ \t]*#[ \t]*include[ \t]*["<](boost/[^">]*)[">]', line)
-        if m:
-            h = m.group(1)
-            mod = module_for_header(h, exceptions, submodule_paths)
-            deps.add(mod)
-    return deps
+    def expect(self, op):
+        if self.next()[2] != op:
+            raise ValueError('Expected ' + op)
+
+    def skip_parentheses(self):
+        self.expect('(')
+        level = 1
+        while level:
+            op = self.next()[2]
+            if op == '(':
+                level += 1
+            elif op == ')':
+                level -= 1
+
+    def ternary(self):
+        c = self.binary(1)
+        if self.peek() != '?':
+            return c
+        self.next()
+        a = self.ternary()
+        self.expect(':')
+        b = self.ternary()
+        if c is None:
+            return a if a == b else None
+        return a if c else b
+
+    def binary(self, min_precedence):
+        left = self.unary()
+        while self.peek() in binary_precedence and binary_precedence[self.peek()] >= min_precedence:
+            op = self.next()[2]
+            right = self.binary(binary_precedence[op] + 1)
+            left = self.apply(op, left, right)
+        return left
+
+    @staticmethod
+    def apply(op, a, b):
+        if op == '&&':
+            if is_false(a) or is_false(b):
+                return 0
+            return None if a is None or b is None else 1
+        if op == '||':
+            if is_true(a) or is_true(b):
+                return 1
+            return None if a is None or b is None else 0
+        if a is None or b is None:
+            return None
+        if op in ('/', '%') and b == 0:
+            return None
+        if op == '/':
+            return int(float(a) / b)
+        if op == '%':
+            return a - b * int(float(a) / b)
+        if op in ('<<', '>>') and not 0 <= b < 64:
+            return None
+        return {
+            '|': lambda: a | b, '^': lambda: a ^ b, '&': lambda: a & b,
+            '==': lambda: int(a == b), '!=': lambda: int(a != b),
+            '<': lambda: int(a < b), '>': lambda: int(a > b), '<=': lambda: int(a <= b), '>=': lambda: int(a >= b),
+            '<<': lambda: a << b, '>>': lambda: a >> b,
+            '+': lambda: a + b, '-': lambda: a - b, '*': lambda: a * b}[op]()
+
+    def unary(self):
+        number, identifier, op = self.next()
+        if op in ('!', '-', '+', '~'):
+            v = self.unary()
+            if v is None:
+                return None
+            return {'!': int(not v), '-': -v, '+': v, '~': ~v}[op]
+        if op == '(':
+            v = self.ternary()
+            self.expect(')')
+            return v
+        if number is not None:
+            return parse_integer(number)
+        if identifier == 'defined':
+            parenthesized = self.peek() == '('
+            if parenthesized:
+                self.next()
+            name = self.next()[1]
+            if name is None:
+                raise ValueError('Expected macro name')
+            if parenthesized:
+                self.expect(')')
+            return self.defined(name)
+        if identifier in ('true', 'false'):
+            return int(identifier == 'true')
+        if identifier is not None:
+            if self.peek() == '(':
+                # Function-like macro or feature test such as __has_include
+                self.skip_parentheses()
+                return None
+            return self.lookup(identifier)
+        raise ValueError('Unexpected token')
+
+
+def parse_integer(s):
+    s = s.replace("'", '').rstrip('uUlL')
+    try:
+        if len(s) > 1 and s[0] == '0' and s[1].isdigit():
+            return int(s, 8)
+        return int(s, 0)
+    except ValueError:
+        return None
+
+
+class Preprocessor:
+    """Finds the include directives outside preprocessor branches known to be inactive.
+
+    Conditionals are evaluated with the predefined macros, the macros known to be undefined,
+    and the macros defined or undefined earlier in the same file. Other macros are unknown
+    unless assume_undefined is set, in which case they are undefined as in a real
+    preprocessor. Branches are only skipped when they are known to be inactive, so an unknown
+    condition keeps the includes of all its branches."""
+
+    def __init__(self, defines=None, undefined=(), assume_undefined=False):
+        self.defines = dict(defines or {})
+        self.undefined = set(undefined)
+        self.assume_undefined = assume_undefined
+
+    def settings(self):
+        # Identifies the configuration, so cached results are discarded when it changes.
+        # Only JSON types are used, so the settings compare equal after a round trip through the cache file.
+        return [[[name, value] for name, value in sorted(self.defines.items())], sorted(self.undefined),
+                self.assume_undefined]
+
+    def includes(self, contents):
+        # (quoted, header) for each include directive in a branch that might be active
+        includes = []
+        if contents.find(b'#') == -1:
+            return includes
+        defines = dict(self.defines)
+        undefined = set(self.undefined)
+        unknown = set()
+
+        def defined(name):
+            if name in unknown:
+                return None
+            if name in defines:
+                return 1
+            if name in undefined or self.assume_undefined:
+                return 0
+            return None
+
+        def lookup(name, expanding=()):
+            if name in unknown or name in expanding:
+                return None
+            if name in defines:
+                if defines[name] is None or not defines[name].strip():
+                    return None
+                try:
+                    return ConditionalExpression(
+                        defines[name], lambda n: lookup(n, expanding + (name,)), defined).evaluate()
+                except (ValueError, IndexError, RecursionError):
+                    return None
+            if name in undefined or self.assume_undefined:
+                return 0
+            return None
+
+        def evaluate(text):
+            try:
+                return ConditionalExpression(text, lookup, defined).evaluate()
+            except (ValueError, IndexError, RecursionError):
+                return None
+
+        # Directives in block comments are ignored
+        comments = block_comments(contents)
+        comment_starts = [start for start, _ in comments]
+
+        # Each frame is [live, certain, taken, maybe_taken]: whether the current branch might be
+        # active, whether it is certainly active, and whether a previous branch in the group was
+        # certainly or possibly taken
+        frames = [[True, True, False, False]]
+        for m in directive_pattern.finditer(contents):
+            if not is_directive(contents, m.start()):
+                continue
+            if comments:
+                i = bisect_right(comment_starts, m.start()) - 1
+                if i >= 0 and m.start() < comments[i][1]:
+                    continue
+            directive = m.group(1)
+            text = m.group(2).decode('latin-1').replace('\\\r\n', ' ').replace('\\\n', ' ')
+            text = re.sub(r'/\*.*?\*/', ' ', text).split('//')[0].strip()
+            live, certain = frames[-1][0], frames[-1][1]
+            if directive in (b'if', b'ifdef', b'ifndef'):
+                v = None
+                if live:
+                    if directive == b'if':
+                        v = evaluate(text)
+                    else:
+                        name = text.split()[0] if text else ''
+                        v = defined(name)
+                        if directive == b'ifndef' and v is not None:
+                            v = int(not v)
+                frames.append([live and not is_false(v), certain and is_true(v), is_true(v), not is_false(v)])
+            elif directive in (b'elif', b'elifdef', b'elifndef', b'else'):
+                if len(frames) == 1:
+                    continue
+                frame = frames[-1]
+                parent_live, parent_certain = frames[-2][0], frames[-2][1]
+                if directive == b'else':
+                    v = 1
+                elif frame[2] or not parent_live:
+                    v = 0
+                elif directive == b'elif':
+                    v = evaluate(text)
+                else:
+                    name = text.split()[0] if text else ''
+                    v = defined(name)
+                    if directive == b'elifndef' and v is not None:
+                        v = int(not v)
+                frame[0] = parent_live and not frame[2] and not is_false(v)
+                frame[1] = parent_certain and not frame[3] and is_true(v)
+                frame[2] = frame[2] or is_true(v)
+                frame[3] = frame[3] or not is_false(v)
+            elif directive == b'endif':
+                if len(frames) > 1:
+                    frames.pop()
+            elif not live:
+                continue
+            elif directive == b'include':
+                include = re.match(r'([<"])([^">]*)[">]', text)
+                if include:
+                    includes.append((include.group(1) == '"', include.group(2)))
+            else:
+                name = re.match(r'[A-Za-z_]\w*', text)
+                if not name:
+                    continue
+                name = name.group(0)
+                if not certain:
+                    unknown.add(name)
+                elif directive == b'define':
+                    unknown.discard(name)
+                    undefined.discard(name)
+                    rest = text[len(name):]
+                    # Function-like macros are defined but have no value we can evaluate
+                    defines[name] = None if rest.startswith('(') else rest
+                else:
+                    unknown.discard(name)
+                    defines.pop(name, None)
+                    undefined.add(name)
+        return includes
+
+
+def scan_boost_includes(contents, preprocessor=None):
+    headers = set()
+    # Most files have no boost includes at all
+    if contents.find(b'boost/') == -1:
+        return headers
+    if preprocessor is not None:
+        return set(h for _, h in preprocessor.includes(contents) if h.startswith('boost/'))
+    for m in include_pattern.finditer(contents):
+        if is_directive(contents, m.start()):
+            headers.add(m.group(1).decode('latin-1'))
+    return headers
+
+
+# Files at least this large are memory-mapped instead of read into memory
+default_mmap_threshold = 4 * 1024 * 1024
+
+
+def read_file(fn, mmap_threshold=default_mmap_threshold):
+    # The patterns search bytes-like objects, so a memory map of a large file can be searched
+    # directly without copying it into a bytes object
+    with open(fn, 'rb') as f:
+        if mmap_threshold and os.fstat(f.fileno()).st_size >= mmap_threshold:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return f.read()
+
+
+def scan_file(fn, mmap_threshold=default_mmap_threshold, preprocessor=None):
+    contents = read_file(fn, mmap_threshold)
+    return scan_boost_includes(contents, preprocessor), len(contents)
+
+
+def blob_digest(contents):
+    # The object id git stores for a file with these contents
+    h = hashlib.sha1('blob {}\0'.format(len(contents)).encode())
+    h.update(contents)
+    return h.hexdigest()
+
+
+def scan_file_record(fn, mmap_threshold=default_mmap_threshold, preprocessor=None):
+    # Scan a file and also return the signature the scan cache stores for it
+    st = os.stat(fn)
+    contents = read_file(fn, mmap_threshold)
+    return scan_boost_includes(contents, preprocessor), st.st_size, st.st_mtime_ns, blob_digest(contents)
+
+
+def file_digest(fn):
+    with open(fn, 'rb') as f:
+        return blob_digest(f.read())
+
+
+git_index_stat_pattern = re.compile(r'  ctime: [^\n]*\n  mtime: (\d+):(\d+)\n[^\n]*\n[^\n]*\n  size: (\d+)[^\n]*\n')
+
+
+def git_index(dir):
+    """Object id, modification time and size git recorded for each tracked file in dir.
+
+    Git records these when a file is checked out or staged, so a file whose modification time and size still
+    match the index entry has the recorded object id. Returns an empty dict when dir is not in a git work tree."""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(['git', '-C', dir, 'ls-files', '-s', '--debug', '-z'], stderr=devnull)
+            index_path = subprocess.check_output(['git', '-C', dir, 'rev-parse', '--git-path', 'index'],
+                                                 stderr=devnull).decode().strip()
+        index_mtime = os.stat(os.path.join(dir, index_path)).st_mtime_ns
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    index = {}
+    # Each entry is "<mode> <object> <stage>\t<path>\0" followed by its stat data on indented lines
+    tokens = output.decode('utf-8', 'surrogateescape').split('\0')
+    header = tokens[0]
+    for token in tokens[1:]:
+        m = git_index_stat_pattern.match(token)
+        if m is None:
+            break
+        mode_object_stage, path = header.split('\t', 1)
+        mode, object_id, stage = mode_object_stage.split(' ')
+        mtime = int(m.group(1)) * 1000000000 + int(m.group(2))
+        # Like git, entries not older than the index are racy, as the file may have changed in the same tick.
+        # Object ids of SHA-256 repositories are never equal to blob_digest, so those entries are not used.
+        if stage == '0' and mode != '160000' and mtime < index_mtime and len(object_id) == 40:
+            index[path] = (object_id, int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        header = token[m.end():]
+    vprint(2, 'Git index has', len(index), 'files in', dir)
+    return index
+
+
+def git_index_matches(index_entry, st):
+    # Without nanosecond timestamps git stores 0 for the nanoseconds
+    _, sec, nsec, size = index_entry
+    if size != st.st_size or sec != st.st_mtime_ns // 1000000000:
+        return False
+    return nsec == 0 or nsec == st.st_mtime_ns % 1000000000
+
+
+class ScanCache:
+    """Boost headers found in each file in a previous run, keyed by the file path relative to the scanned directory.
+
+    An entry is reused when the file size and modification time are unchanged. When only the modification
+    time changed, as in a fresh checkout, the entry is still reused if the git object id is unchanged. The object
+    id comes from the git index when the file still matches the stat data git recorded for it, so checked out
+    files are not read again, and is computed from the file contents otherwise.
+    The cache stores headers rather than modules, so it remains valid when the boost branch changes.
+    Entries found with other preprocessor settings are discarded."""
+
+    version = 2
+
+    def __init__(self, path, settings=None):
+        self.path = path
+        self.settings = settings
+        self.entries = {}
+        self.used = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                if data.get('version') == self.version and data.get('settings') == settings:
+                    self.entries = data['files']
+            except (ValueError, KeyError):
+                vprint(1, 'Ignoring invalid scan cache', path)
+        vprint(1, 'Scan cache has', len(self.entries), 'files')
+
+    def lookup(self, key, fn, index_entry=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        st = os.stat(fn)
+        if entry['size'] != st.st_size:
+            return None
+        if entry['mtime'] != st.st_mtime_ns:
+            if index_entry is not None and git_index_matches(index_entry, st):
+                blob = index_entry[0]
+            else:
+                blob = file_digest(fn)
+            if entry['blob'] != blob:
+                return None
+            entry['mtime'] = st.st_mtime_ns
+        self.used[key] = entry
+        return entry['headers']
+
+    def update(self, key, record):
+        headers, size, mtime, blob = record
+        self.used[key] = {'size': size, 'mtime': mtime, 'blob': blob, 'headers': sorted(headers)}
+
+    def save(self):
+        # Only files seen in this run are kept, so removed files do not accumulate
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        with open(self.path, 'w') as f:
+            # json.dumps uses the C encoder, which json.dump does not use when writing to a file
+            f.write(json.dumps({'version': self.version, 'settings': self.settings, 'files': self.used}))
+        vprint(1, 'Scan cache saved with', len(self.used), 'files')
+
+
+# Extensions of the files scanned by default
+source_extensions = ['.c', '.cc', '.cpp', '.cxx', '.c++', '.cppm', '.ixx', '.cu', '.mm',
+                     '.h', '.hh', '.hpp', '.hxx', '.h++', '.ipp', '.inl', '.inc', '.tpp', '.tcc', '.txx', '.cuh']
+
+
+def has_extension(file, extensions):
+    # Configured files such as config.hpp.in are matched by the extension before the .in suffix
+    file = file.lower()
+    if file.endswith('.in'):
+        file = file[:-len('.in')]
+    return os.path.splitext(file)[1] in extensions
 
 
-def scan_directory(d, exceptions, submodule_paths):
+def read_gitignore(d):
+    # Rules as (pattern, negated, dir_only, anchored). Patterns are matched with fnmatch,
+    # which covers the common .gitignore syntax but not "**" across directories.
+    rules = []
+    with open(os.path.join(d, '.gitignore'), 'r') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            anchored = '/' in line
+            rules.append((line.lstrip('/'), negated, dir_only, anchored))
+    return rules
+
+
+def is_ignored(path, is_dir, gitignores):
+    # gitignores lists (directory, rules) for each .gitignore that applies to path
+    ignored = False
+    for base, rules in gitignores:
+        rel = os.path.relpath(path, base).replace(os.sep, '/')
+        name = os.path.basename(path)
+        for pattern, negated, dir_only, anchored in rules:
+            if dir_only and not is_dir:
+                continue
+            if fnmatch.fnmatch(rel if anchored else name, pattern):
+                ignored = not negated
+    return ignored
+
+
+def list_directory_files(d, extensions=None, max_size=0, gitignores=None):
     vprint(1, 'Scanning directory', d)
 
     if os.name == 'nt' and sys.version_info[0] < 3:
         d = unicode(d)
 
-    deps = set()
-    for root, dirs, files in os.walk(d):
-        for file in files:
+    files = []
+    # .gitignore rules that apply to each directory about to be walked
+    dir_gitignores = {d: gitignores}
+    for root, dirs, filenames in os.walk(d):
+        root_gitignores = dir_gitignores.pop(root, None)
+        if root_gitignores is not None and '.gitignore' in filenames:
+            root_gitignores = root_gitignores + [(root, read_gitignore(root))]
+
+        dirs[:] = [x for x in dirs if x != '.git']
+        if root_gitignores:
+            dirs[:] = [x for x in dirs if not is_ignored(os.path.join(root, x), True, root_gitignores)]
+        for x in dirs:
+            dir_gitignores[os.path.join(root, x)] = root_gitignores
+
+        for file in filenames:
+            if extensions is not None and not has_extension(file, extensions):
+                continue
             fn = os.path.join(root, file)
-            vprint(2, 'Scanning file', fn)
-            if sys.version_info[0] < 3:
-                with open(fn, 'r') as f:
-                    deps.update(scan_header_dependencies(f, exceptions, submodule_paths))
+            if root_gitignores and is_ignored(fn, False, root_gitignores):
+                continue
+            if max_size and os.path.getsize(fn) > max_size:
+                vprint(1, 'Skipping large file', fn)
+                continue
+            files.append(fn)
+    return files
+
+
+class ScanReport:
+    """Where each module was found and where the scan spent its time."""
+
+    def __init__(self, dir):
+        self.dir = dir
+        self.files_scanned = 0
+        self.files_cached = 0
+        self.bytes_read = 0
+        self.timings = {'index': 0.0, 'walk': 0.0, 'scan': 0.0, 'resolve': 0.0}
+        # boost header -> files including it
+        self.header_files = {}
+        # boost header -> module
+        self.header_modules = {}
+
+    def add_file(self, fn, headers, size=None):
+        if size is None:
+            self.files_cached += 1
+        else:
+            self.files_scanned += 1
+            self.bytes_read += size
+        fn = os.path.relpath(fn, self.dir).replace(os.sep, '/')
+        for h in headers:
+            self.header_files.setdefault(h, []).append(fn)
+
+    def add_time(self, step, start):
+        self.timings[step] += time.time() - start
+
+    def to_json(self):
+        modules = {}
+        unresolved = {}
+        for h, files in self.header_files.items():
+            mod = self.header_modules.get(h)
+            if mod is None:
+                unresolved[h] = sorted(files)
             else:
-                with open(fn, 'r', encoding='latin-1') as f:
-                    deps.update(scan_header_dependencies(f, exceptions, submodule_paths))
-    return deps
+                modules.setdefault(mod, {})[h] = sorted(files)
+        return {
+            'modules': dict((m, {'headers': hs, 'files': sorted(set(f for fs in hs.values() for f in fs))})
+                            for m, hs in modules.items()),
+            'unresolved': unresolved,
+            'counters': {
+                'files_scanned': self.files_scanned,
+                'files_cached': self.files_cached,
+                'bytes_read': self.bytes_read
+            },
+            'timings': self.timings
+        }
 
 
-def list_boost_dependencies(dir, subdirs, exceptions, submodule_paths):
-    vprint(1, 'Scanning dir', dir)
-    deps = set()
+def resolve_headers(headers, resolve, report=None):
+    start = time.time()
+    modules = set()
+    for h in headers:
+        mod = resolve(h)
+        modules.add(mod)
+        if report is not None:
+            report.header_modules[h] = mod
+    if report is not None:
+        report.add_time('resolve', start)
+    return modules
+
+
+def map_files(func, files, jobs):
+    if jobs > 1 and len(files) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        vprint(1, 'Scanning', len(files), 'files with', jobs, 'jobs')
+        # Large chunks keep the inter-process overhead low while still balancing the load
+        chunksize = max(1, len(files) // (jobs * 4))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for result in executor.map(func, files, chunksize=chunksize):
+                yield result
+    else:
+        for fn in files:
+            vprint(2, 'Scanning file', fn)
+            yield func(fn)
+
+
+def scan_files(files, jobs, mmap_threshold=default_mmap_threshold, report=None, preprocessor=None):
+    headers = set()
+    scan = functools.partial(scan_file, mmap_threshold=mmap_threshold, preprocessor=preprocessor)
+    for fn, (file_headers, size) in zip(files, map_files(scan, files, jobs)):
+        headers.update(file_headers)
+        if report is not None:
+            report.add_file(fn, file_headers, size)
+    return headers
+
+
+def scan_files_cached(dir, files, jobs, cache, mmap_threshold=default_mmap_threshold, report=None,
+                      preprocessor=None):
+    headers = set()
+    stale = []
+    index = git_index(dir)
+    for fn in files:
+        key = os.path.relpath(fn, dir).replace(os.sep, '/')
+        cached = cache.lookup(key, fn, index.get(key))
+        if cached is None:
+            stale.append((key, fn))
+        else:
+            headers.update(cached)
+            if report is not None:
+                report.add_file(fn, cached)
+    vprint(1, 'Reusing', len(files) - len(stale), 'cached files, scanning', len(stale), 'files')
+    scan = functools.partial(scan_file_record, mmap_threshold=mmap_threshold, preprocessor=preprocessor)
+    records = map_files(scan, [fn for _, fn in stale], jobs)
+    for (key, fn), record in zip(stale, records):
+        cache.update(key, record)
+        headers.update(record[0])
+        if report is not None:
+            report.add_file(fn, record[0], record[1])
+    return headers
+
+
+def list_project_files(dir, subdirs, extensions=source_extensions, max_size=0, gitignore=True):
+    # The project .gitignore also applies to the scanned subdirectories
+    gitignores = None
+    if gitignore:
+        gitignores = []
+        if os.path.isfile(os.path.join(dir, '.gitignore')):
+            gitignores.append((dir, read_gitignore(dir)))
+    files = []
     for subdir in subdirs:
-        deps.update(scan_directory(os.path.join(dir, subdir), exceptions, submodule_paths))
-    return deps
+        files.extend(list_directory_files(os.path.join(dir, subdir), extensions, max_size, gitignores))
+    return files
+
+
+def list_boost_dependencies(dir, subdirs, resolve, jobs=1, cache=None, extensions=source_extensions, max_size=0,
+                            gitignore=True, mmap_threshold=default_mmap_threshold, report=None, preprocessor=None):
+    vprint(1, 'Scanning dir', dir)
+    start = time.time()
+    files = list_project_files(dir, subdirs, extensions, max_size, gitignore)
+    if report is not None:
+        report.add_time('walk', start)
+        start = time.time()
+    if cache is None:
+        headers = scan_files(files, jobs, mmap_threshold, report, preprocessor)
+    else:
+        headers = scan_files_cached(dir, files, jobs, cache, mmap_threshold, report, preprocessor)
+    if report is not None:
+        report.add_time('scan', start)
+    return resolve_headers(headers, resolve, report)
+
 
+def is_subpath(child_path, parent_path):
+    return child_path.startswith(os.path.join(parent_path, ''))
 
-def read_exceptions(branch):
+
+def read_compile_commands(path, dir):
+    # Translation units in dir and the include directories in dir they are compiled with
+    vprint(1, 'Reading', path)
+    with open(path, 'r') as f:
+        compile_commands = json.load(f)
+    dir = os.path.abspath(dir)
+    sources = []
+    include_dirs = []
+    for entry in compile_commands:
+        cwd = entry.get('directory', os.path.dirname(path))
+        source = os.path.normpath(os.path.join(cwd, entry['file']))
+        if is_subpath(source, dir) and source not in sources:
+            if os.path.isfile(source):
+                sources.append(source)
+            else:
+                # Such as generated sources in a build that has not run yet
+                vprint(1, 'Skipping missing source', source)
+        args = entry['arguments'] if 'arguments' in entry else shlex.split(entry['command'])
+        for i, arg in enumerate(args):
+            include_dir = None
+            for option in ('-isystem', '-iquote', '-I', '/I'):
+                if arg == option and i + 1 < len(args):
+                    include_dir = args[i + 1]
+                elif arg.startswith(option) and len(arg) > len(option):
+                    include_dir = arg[len(option):]
+                if include_dir is not None:
+                    break
+            if include_dir is None:
+                continue
+            include_dir = os.path.normpath(os.path.join(cwd, include_dir))
+            if is_subpath(include_dir, dir) and include_dir not in include_dirs:
+                include_dirs.append(include_dir)
+    return sources, include_dirs
+
+
+def scan_includes(contents, preprocessor=None):
+    # (quoted, header) for each include directive in the file
+    if contents.find(b'include') == -1:
+        return []
+    if preprocessor is not None:
+        return preprocessor.includes(contents)
+    return [(m.group(1) == b'"', m.group(2).decode('latin-1')) for m in any_include_pattern.finditer(contents)
+            if is_directive(contents, m.start())]
+
+
+def follow_boost_dependencies(sources, include_dirs, resolve, mmap_threshold=default_mmap_threshold, report=None,
+                              preprocessor=None):
+    """Scan the sources and every project header reachable from them through include directives.
+
+    Quoted includes are looked up relative to the including file and then in the include
+    directories. Angle bracket includes are only looked up in the include directories.
+    Headers that cannot be found in the project, such as boost or standard headers, are
+    not followed."""
+    vprint(1, 'Following includes from', len(sources), 'sources')
+    start = time.time()
+    headers = set()
+    visited = set()
+    found = {}
+    pending = [os.path.abspath(s) for s in sources]
+    while pending:
+        fn = pending.pop()
+        if fn in visited:
+            continue
+        visited.add(fn)
+        vprint(2, 'Scanning file', fn)
+        contents = read_file(fn, mmap_threshold)
+        current_dir = os.path.dirname(fn)
+        file_headers = set()
+        for quoted, h in scan_includes(contents, preprocessor):
+            if h.startswith('boost/'):
+                file_headers.add(h)
+            key = (current_dir if quoted else None, h)
+            if key not in found:
+                found[key] = None
+                search_dirs = [current_dir] + include_dirs if quoted else include_dirs
+                for d in search_dirs:
+                    candidate = os.path.normpath(os.path.join(d, h))
+                    if os.path.isfile(candidate):
+                        found[key] = candidate
+                        break
+            if found[key] is not None and found[key] not in visited:
+                pending.append(found[key])
+        headers.update(file_headers)
+        if report is not None:
+            report.add_file(fn, file_headers, len(contents))
+    vprint(1, 'Scanned', len(visited), 'reachable files')
+    if report is not None:
+        report.add_time('scan', start)
+    return resolve_headers(headers, resolve, report)
+
+
+def read_exceptions(branch, offline=False, data_dir=script_dir):
     # exceptions.txt is the output of "boostdep --list-exceptions"
     vprint(1, 'Reading exceptions.txt')
     x = {}
     module = None
 
-    exceptions_path = os.path.join(os.path.dirname(sys.argv[0]), branch + '.exceptions.txt')
-    if not os.path.exists(exceptions_path):
+    exceptions_path = os.path.join(data_dir, branch + '.exceptions.txt')
+    if not os.path.exists(exceptions_path) and not offline:
         import requests
         url = "https://raw.githubusercontent.com/boostorg/boostdep/" + branch + "/depinst/exceptions.txt"
         response = requests.get(url)
@@ -148,12 +943,12 @@ def read_exceptions(branch):
     return x
 
 
-def read_gitmodules(branch):
+def read_gitmodules(branch, offline=False, data_dir=script_dir):
     vprint(1, 'Reading .gitmodules')
     gm = []
 
-    gitmodules_path = os.path.join(os.path.dirname(sys.argv[0]), branch + '.gitmodules')
-    if not os.path.exists(gitmodules_path):
+    gitmodules_path = os.path.join(data_dir, branch + '.gitmodules')
+    if not os.path.exists(gitmodules_path) and not offline:
         import requests
         url = "https://raw.githubusercontent.com/boostorg/boost/" + branch + "/.gitmodules"
         response = requests.get(url)
@@ -172,6 +967,189 @@ def read_gitmodules(branch):
     return gm
 
 
+def parse_dependency_list(text):
+    # Lines in the format of "boostdep --list-dependencies": "module -> dep1 dep2 ..."
+    deps = {}
+    for line in text.splitlines():
+        if '->' not in line:
+            continue
+        m, ds = line.split('->', 1)
+        if m.strip():
+            deps[m.strip()] = ds.split()
+    return deps
+
+
+def default_dependencies_path(branch, data_dir=script_dir):
+    # The output of "boostdep --list-dependencies", or the same graph as a JSON object
+    for ext in ['.deps.txt', '.deps.json']:
+        path = os.path.join(data_dir, branch + ext)
+        if os.path.exists(path):
+            return path
+    return os.path.join(data_dir, branch + '.deps.txt')
+
+
+def read_dependencies(branch, path='', data_dir=script_dir):
+    # Maps each module to the modules it directly depends on. The file is either the output of
+    # "boostdep --list-dependencies" or a JSON object with the same graph.
+    if not path:
+        path = default_dependencies_path(branch, data_dir)
+    if not os.path.exists(path):
+        vprint(1, 'No module dependency graph at', path)
+        return None
+    vprint(1, 'Reading', os.path.basename(path))
+    with open(path, 'r') as f:
+        contents = f.read()
+    if contents.lstrip().startswith('{'):
+        deps = json.loads(contents)
+    else:
+        deps = parse_dependency_list(contents)
+    # boostdep names nested modules such as numeric~conversion with "~"
+    return dict((m.replace('~', '/'), [d.replace('~', '/') for d in ds]) for m, ds in deps.items())
+
+
+def default_index_path(branch, data_dir=script_dir):
+    return os.path.join(data_dir, branch + '.index.json')
+
+
+def build_index(branch, deps_path='', offline=False, data_dir=script_dir):
+    # The index holds everything the scan needs from exceptions.txt, .gitmodules and
+    # the dependency graph, so the scan can run offline without parsing them
+    return {
+        'version': 1,
+        'branch': branch,
+        'exceptions': read_exceptions(branch, offline, data_dir),
+        'modules': sorted(submodule_index(read_gitmodules(branch, offline, data_dir))),
+        'dependencies': read_dependencies(branch, deps_path, data_dir)
+    }
+
+
+def write_index(index, path):
+    with open(path, 'w') as f:
+        json.dump(index, f, sort_keys=True)
+    vprint(1, 'Index saved to', path)
+
+
+def read_index(path):
+    if not os.path.exists(path):
+        return None
+    vprint(1, 'Reading', os.path.basename(path))
+    with open(path, 'r') as f:
+        index = json.load(f)
+    if index.get('version') != 1:
+        vprint(1, 'Ignoring index with unknown version', path)
+        return None
+    return index
+
+
+def transitive_dependencies(modules, dependencies):
+    closure = set()
+    pending = list(modules)
+    while pending:
+        m = pending.pop()
+        if m in closure:
+            continue
+        closure.add(m)
+        if m not in dependencies:
+            vprint(1, 'Module', m, 'is not in the dependency graph')
+            continue
+        pending.extend(dependencies[m])
+    return closure
+
+
+class Scanner:
+    """Scans projects for the boost modules they depend on.
+
+    The index and the header resolution cache are loaded once and shared by every scan,
+    so one Scanner can scan many projects without parsing the boost data again. With a
+    Preprocessor, includes in preprocessor branches known to be inactive are ignored::
+
+        scanner = Scanner('develop')
+        for project in projects:
+            print(scanner.scan(project))
+    """
+
+    def __init__(self, branch='master', index_path='', deps_path='', offline=False, data_dir=script_dir,
+                 preprocessor=None):
+        self.branch = branch
+        self.preprocessor = preprocessor
+        start = time.time()
+        if index_path and not os.path.exists(index_path):
+            # Only the default index is optional
+            raise IOError('Index not found: {}'.format(index_path))
+        self.index = read_index(index_path or default_index_path(branch, data_dir))
+        if self.index is None:
+            self.index = build_index(branch, deps_path, offline, data_dir)
+        elif deps_path:
+            self.index['dependencies'] = read_dependencies(branch, deps_path, data_dir)
+        self.load_time = time.time() - start
+        self.resolve = ModuleResolver(self.index['exceptions'], self.index['modules'])
+
+    def report(self, dir):
+        report = ScanReport(dir)
+        report.timings['index'] = self.load_time
+        return report
+
+    def scan(self, dir, subdirs=default_subdirs, jobs=1, cache=None, extensions=source_extensions, max_size=0,
+             gitignore=True, mmap_threshold=default_mmap_threshold, report=None):
+        """Modules included by the files in the subdirectories of dir. None stands for unknown modules."""
+        return list_boost_dependencies(dir, subdirs, self.resolve, jobs, cache, extensions, max_size, gitignore,
+                                       mmap_threshold, report, self.preprocessor)
+
+    def follow(self, dir, sources=(), compile_commands='', mmap_threshold=default_mmap_threshold, report=None):
+        """Modules included by the project files in dir reachable from the sources and compile commands."""
+        sources = [os.path.join(dir, s) for s in sources]
+        include_dirs = [os.path.join(os.path.abspath(dir), 'include')]
+        if compile_commands:
+            cc_sources, cc_include_dirs = read_compile_commands(compile_commands, dir)
+            sources.extend(cc_sources)
+            include_dirs.extend(d for d in cc_include_dirs if d not in include_dirs)
+        vprint(1, 'Include directories:', *include_dirs)
+        return follow_boost_dependencies(sources, include_dirs, self.resolve, mmap_threshold, report,
+                                         self.preprocessor)
+
+    def watch(self, dir, subdirs=default_subdirs, extensions=source_extensions, max_size=0, gitignore=True,
+              mmap_threshold=default_mmap_threshold, interval=1.0):
+        """Yield the modules included by the files in the subdirectories of dir, and again whenever they change.
+
+        The directories are polled every interval seconds. The headers found in each file are kept
+        in memory, so only new or modified files are scanned again."""
+        files = {}
+        modules = None
+        while True:
+            current = {}
+            for fn in list_project_files(dir, subdirs, extensions, max_size, gitignore):
+                try:
+                    st = os.stat(fn)
+                    entry = files.get(fn)
+                    if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+                        vprint(2, 'Scanning file', fn)
+                        entry = (st.st_size, st.st_mtime_ns, scan_file(fn, mmap_threshold, self.preprocessor)[0])
+                except (IOError, OSError):
+                    # Removed between listing and reading
+                    continue
+                current[fn] = entry
+            files = current
+            headers = set()
+            for entry in files.values():
+                headers.update(entry[2])
+            changed_modules = resolve_headers(headers, self.resolve)
+            if changed_modules != modules:
+                modules = changed_modules
+                yield set(modules)
+            time.sleep(interval)
+
+    def transitive_dependencies(self, modules):
+        if self.index['dependencies'] is None:
+            raise ValueError('Cannot list transitive dependencies without a module dependency graph')
+        return transitive_dependencies(modules, self.index['dependencies'])
+
+
+def select_modules(modules, ignore=(), extra=()):
+    modules = set(m for m in modules if m is not None and m not in ignore)
+    modules.update(m.replace('~', '/') for m in extra)
+    return modules
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Installs the dependencies needed to test a Boost library.')
 
@@ -185,24 +1163,93 @@ if __name__ == "__main__":
                         metavar='DIR', action='append', default=[])
     parser.add_argument('-N', '--ignore', help="exclude top-level dependency even when found in scan; can be repeated",
                         metavar='LIB', action='append', default=[])
+    parser.add_argument('-M', '--module', help="module to include in the results even when not found in scan; can be repeated",
+                        metavar='LIB', action='append', default=[])
+    parser.add_argument('-T', '--transitive', help="also list the transitive dependencies of the modules found",
+                        action='store_true')
+    parser.add_argument('--deps', help="module dependency graph used by --transitive, as output by "
+                                       "'boostdep --track-sources --list-dependencies' or as a JSON object "
+                                       "(default: <branch>.deps.txt or <branch>.deps.json)",
+                        metavar='FILE', default='')
+    parser.add_argument('--index', help="prebuilt index of the boost modules (default: <branch>.index.json)",
+                        metavar='FILE', default='')
+    parser.add_argument('--build-index', help="write the index for --branch from exceptions.txt, .gitmodules and "
+                                              "the dependency graph, and exit", action='store_true')
+    parser.add_argument('--offline', help="never download exceptions.txt or .gitmodules", action='store_true')
+    parser.add_argument('--compile-commands', help="scan only the project files reachable through include directives "
+                                                   "from the translation units in this compile_commands.json",
+                        metavar='FILE', default='')
+    parser.add_argument('-F', '--follow', help="scan only the project files reachable through include directives from "
+                                               "this translation unit; can be repeated", metavar='FILE',
+                        action='append', default=[])
+    parser.add_argument('-E', '--extensions', help="comma-separated extensions of the files to scan, or '*' to scan "
+                                                   "all files; configured files such as config.hpp.in are matched by the "
+                                                   "extension before .in (default: C and C++ sources and headers)",
+                        default=','.join(source_extensions))
+    parser.add_argument('--max-file-size', help="skip files larger than this number of bytes; 0 for no limit",
+                        type=int, default=0)
+    parser.add_argument('--no-gitignore', help="also scan files ignored by .gitignore", action='store_true')
+    parser.add_argument('--mmap-threshold', help="memory-map files of at least this number of bytes instead of "
+                                                 "reading them; 0 never maps files",
+                        type=int, default=default_mmap_threshold)
+    parser.add_argument('-P', '--preprocess', help="ignore includes in preprocessor branches known to be inactive",
+                        action='store_true')
+    parser.add_argument('-D', '--define', help="macro defined for --preprocess, as NAME or NAME=VALUE; can be repeated",
+                        metavar='MACRO', action='append', default=[])
+    parser.add_argument('-U', '--undefine', help="macro known to be undefined for --preprocess; can be repeated",
+                        metavar='NAME', action='append', default=[])
+    parser.add_argument('--assume-undefined', help="treat macros not defined with --define or in the scanned file as "
+                                                   "undefined in --preprocess mode", action='store_true')
+    parser.add_argument('-j', '--jobs', help="number of processes scanning files; 0 uses all available cores",
+                        type=int, default=1)
+    parser.add_argument('--cache', help="file where the headers found in each scanned file are kept between runs",
+                        metavar='FILE', default='')
+    parser.add_argument('--report', help="write a report of the files each module was found in and of the scan "
+                                         "timings", choices=['json'], default=None)
+    parser.add_argument('--report-output', help="report file", metavar='FILE', default='scan-deps-report.json')
+    parser.add_argument('-W', '--watch', help="keep scanning and print the modules again whenever they change",
+                        action='store_true')
+    parser.add_argument('--watch-interval', help="seconds between checks for modified files in --watch mode",
+                        type=float, default=1.0)
     parser.add_argument('-v', '--verbose', help='enable verbose output', action='count', default=0)
     parser.add_argument('-q', '--quiet', help='quiet output (opposite of -v)', action='count', default=0)
 
     args = parser.parse_args()
 
+    if args.watch:
+        # Watch mode rescans the subdirectories itself and only prints the modules
+        for option, value in [('--follow', args.follow), ('--compile-commands', args.compile_commands),
+                              ('--cache', args.cache), ('--report', args.report)]:
+            if value:
+                parser.error('{} cannot be used with --watch'.format(option))
+
     verbose = args.verbose - args.quiet
 
     vprint(2, '-X:', args.exclude)
     vprint(2, '-I:', args.include)
     vprint(2, '-N:', args.ignore)
 
-    exceptions = read_exceptions(args.branch)
-    vprint(2, 'Exceptions:', exceptions)
+    if args.build_index:
+        write_index(build_index(args.branch, args.deps, args.offline), args.index or default_index_path(args.branch))
+        sys.exit(0)
 
-    submodule_paths = read_gitmodules(args.branch)
-    vprint(2, '.gitmodules:', submodule_paths)
+    preprocessor = None
+    if args.preprocess:
+        defines = {}
+        for define in args.define:
+            name, _, value = define.partition('=')
+            defines[name] = value if '=' in define else '1'
+        preprocessor = Preprocessor(defines, args.undefine, args.assume_undefined)
 
-    subdirs = ['include', 'src', 'source', 'test', 'tests', 'example', 'examples']
+    try:
+        scanner = Scanner(args.branch, args.index, args.deps, args.offline, preprocessor=preprocessor)
+    except IOError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    vprint(2, 'Exceptions:', scanner.index['exceptions'])
+    vprint(2, 'Modules:', scanner.index['modules'])
+
+    subdirs = list(default_subdirs)
     for subdir in args.exclude:
         if subdir in subdirs:
             subdirs.remove(subdir)
@@ -211,13 +1258,62 @@ if __name__ == "__main__":
             subdirs.append(subdir)
     vprint(1, 'Directories to scan:', *subdirs)
 
-    modules = list_boost_dependencies(args.dir, subdirs, exceptions, submodule_paths)
-    for ignored in args.ignore:
-        if ignored in modules:
-            modules.remove(ignored)
+    extensions = None
+    if args.extensions != '*':
+        extensions = set(e.strip().lower() for e in args.extensions.split(',') if e.strip())
+        extensions = set(e if e.startswith('.') else '.' + e for e in extensions)
+
+    if args.watch:
+        # Changes in the scanned modules might not change the selected modules or their closure
+        printed = None
+        try:
+            for modules in scanner.watch(args.dir, subdirs, extensions, args.max_file_size, not args.no_gitignore,
+                                         args.mmap_threshold, args.watch_interval):
+                modules = select_modules(modules, args.ignore, args.module)
+                if args.transitive:
+                    try:
+                        modules = scanner.transitive_dependencies(modules)
+                    except ValueError as e:
+                        print(e, file=sys.stderr)
+                        sys.exit(1)
+                if modules == printed:
+                    continue
+                printed = modules
+                print(' '.join(sorted(modules)))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    report = scanner.report(args.dir) if args.report else None
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    if args.compile_commands or args.follow:
+        for path in [args.compile_commands] + [os.path.join(args.dir, s) for s in args.follow]:
+            if path and not os.path.isfile(path):
+                print('File not found:', path, file=sys.stderr)
+                sys.exit(1)
+        modules = scanner.follow(args.dir, args.follow, args.compile_commands, args.mmap_threshold, report)
+    else:
+        cache = None
+        if args.cache:
+            cache = ScanCache(args.cache, preprocessor.settings() if preprocessor is not None else None)
+        modules = scanner.scan(args.dir, subdirs, jobs, cache, extensions, args.max_file_size, not args.no_gitignore,
+                               args.mmap_threshold, report)
+        if cache is not None:
+            cache.save()
+    modules = select_modules(modules, args.ignore, args.module)
+
+    if args.transitive:
+        try:
+            modules = scanner.transitive_dependencies(modules)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
 
-    while None in modules:
-        modules.remove(None)
+    if report is not None:
+        with open(args.report_output, 'w') as f:
+            json.dump(report.to_json(), f, indent=2, sort_keys=True)
+        vprint(1, 'Report saved to', args.report_output)
 
     sorted_modules = sorted(modules)
     print(' '.join(sorted_modules))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2023 Alan de Freitas (alandefreitas@gmail.com)
+#
+# Distributed under the Boost Software License, Version 1.0.
+# (See accompanying file LICENSE_1_0.txt or copy at http://www.boost.org/LICENSE_1_0.txt)
+#
+# Official repository: https://github.com/alandefreitas/cpp-actions
+#
+
+# Tests for scan_deps.py. Run with: python -m unittest test_scan_deps
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import scan_deps
+
+# (description, preprocessor arguments, source, expected boost headers)
+preprocessor_cases = [
+    ('plain include', {},
+     '#include <boost/a.hpp>\n',
+     ['boost/a.hpp']),
+    ('quoted include', {},
+     '#include "boost/a.hpp"\n',
+     ['boost/a.hpp']),
+    ('if 0', {},
+     '#if 0\n#include <boost/a.hpp>\n#endif\n#include <boost/b.hpp>\n',
+     ['boost/b.hpp']),
+    ('if 1 with else', {},
+     '#if 1\n#include <boost/a.hpp>\n#else\n#include <boost/b.hpp>\n#endif\n',
+     ['boost/a.hpp']),
+    ('unknown macro keeps all branches', {},
+     '#if FOO\n#include <boost/a.hpp>\n#else\n#include <boost/b.hpp>\n#endif\n',
+     ['boost/a.hpp', 'boost/b.hpp']),
+    ('defined macro', {'defines': {'FOO': '1'}},
+     '#ifdef FOO\n#include <boost/a.hpp>\n#else\n#include <boost/b.hpp>\n#endif\n',
+     ['boost/a.hpp']),
+    ('undefined macro', {'undefined': ['FOO']},
+     '#ifndef FOO\n#include <boost/a.hpp>\n#else\n#include <boost/b.hpp>\n#endif\n',
+     ['boost/a.hpp']),
+    ('assume undefined', {'assume_undefined': True},
+     '#if defined(FOO) && FOO > 2\n#include <boost/a.hpp>\n#endif\n#include <boost/b.hpp>\n',
+     ['boost/b.hpp']),
+    ('elif chain', {'defines': {'V': '2'}},
+     '#if V == 1\n#include <boost/a.hpp>\n#elif V == 2\n#include <boost/b.hpp>\n#else\n'
+     '#include <boost/c.hpp>\n#endif\n',
+     ['boost/b.hpp']),
+    ('arithmetic', {},
+     '#if (2 + 3) * 4 == 20 && !(1 > 2) ? 1 : 0\n#include <boost/a.hpp>\n#endif\n',
+     ['boost/a.hpp']),
+    ('nested inactive branch', {},
+     '#if 1\n#if 0\n#include <boost/a.hpp>\n#endif\n#include <boost/b.hpp>\n#endif\n',
+     ['boost/b.hpp']),
+    ('define in file', {},
+     '#define USE_A 0\n#if USE_A\n#include <boost/a.hpp>\n#endif\n',
+     []),
+    ('undef in file', {'defines': {'USE_A': '1'}},
+     '#undef USE_A\n#ifdef USE_A\n#include <boost/a.hpp>\n#endif\n',
+     []),
+    ('define in unknown branch is unknown', {},
+     '#ifdef FOO\n#define USE_A 1\n#endif\n#if USE_A\n#include <boost/a.hpp>\n#endif\n',
+     ['boost/a.hpp']),
+    ('function-like macro is unknown', {},
+     '#define F(x) x\n#if F(0)\n#include <boost/a.hpp>\n#endif\n',
+     ['boost/a.hpp']),
+    ('line continuation', {},
+     '#if 1 && \\\n    0\n#include <boost/a.hpp>\n#endif\n',
+     []),
+    ('directives in block comments', {},
+     '/*\n#if 0\n*/\n#include <boost/a.hpp>\n',
+     ['boost/a.hpp']),
+    ('include in block comment', {},
+     '/* #include <boost/a.hpp>\n#include <boost/b.hpp>\n*/\n',
+     []),
+    ('comment start in line comment', {},
+     '// /*\n#if 0\n#include <boost/a.hpp>\n#endif\n',
+     []),
+    ('comment start in string', {},
+     'const char* s = "/*";\n#if 0\n#include <boost/a.hpp>\n#endif\n#include <boost/b.hpp>\n',
+     ['boost/b.hpp']),
+    ('comment in directive', {},
+     '#if 0 /* disabled */\n#include <boost/a.hpp>\n#endif\n',
+     []),
+]
+
+
+class PreprocessorTest(unittest.TestCase):
+    def test_includes(self):
+        for description, kwargs, source, expected in preprocessor_cases:
+            preprocessor = scan_deps.Preprocessor(**kwargs)
+            headers = scan_deps.scan_boost_includes(source.encode(), preprocessor)
+            self.assertEqual(sorted(headers), expected, description)
+
+    def test_settings_survive_cache(self):
+        preprocessor = scan_deps.Preprocessor({'A': '1', 'B': None}, ['C'])
+        settings = preprocessor.settings()
+        self.assertEqual(json.loads(json.dumps(settings)), settings)
+
+
+class DependenciesTest(unittest.TestCase):
+    def test_boostdep_list(self):
+        data_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(data_dir, 'master.deps.txt'), 'w') as f:
+                f.write('config ->\nnumeric~conversion -> config\nlexical_cast -> config numeric~conversion\n')
+            deps = scan_deps.read_dependencies('master', data_dir=data_dir)
+        finally:
+            shutil.rmtree(data_dir)
+        self.assertEqual(deps, {'config': [], 'numeric/conversion': ['config'],
+                                'lexical_cast': ['config', 'numeric/conversion']})
+        self.assertEqual(sorted(scan_deps.transitive_dependencies(['lexical_cast'], deps)),
+                         ['config', 'lexical_cast', 'numeric/conversion'])
+
+
+class ScanCacheTest(unittest.TestCase):
+    def test_fresh_checkout(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            repo = os.path.join(work_dir, 'repo')
+            os.makedirs(repo)
+            for name, include in [('a.cpp', 'boost/a.hpp'), ('b.cpp', 'boost/b.hpp')]:
+                with open(os.path.join(repo, name), 'w') as f:
+                    f.write('#include <{}>\n'.format(include))
+            try:
+                subprocess.check_call(['git', 'init', '-q', repo])
+                subprocess.check_call(['git', '-C', repo, 'add', '-A'])
+                subprocess.check_call(['git', '-C', repo, '-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                                       'commit', '-q', '-m', 'files'])
+            except (OSError, subprocess.CalledProcessError):
+                self.skipTest('git is not available')
+            cache_path = os.path.join(work_dir, 'cache.json')
+            cache = scan_deps.ScanCache(cache_path)
+            files = [os.path.join(repo, 'a.cpp'), os.path.join(repo, 'b.cpp')]
+            scan_deps.scan_files_cached(repo, files, 1, cache)
+            cache.save()
+
+            checkout = os.path.join(work_dir, 'checkout')
+            subprocess.check_call(['git', 'clone', '-q', repo, checkout])
+            # Entries written in the same timestamp tick as the index are racy and never reused from the index
+            time.sleep(0.05)
+            subprocess.check_call(['git', '-C', checkout, 'update-index', '-q', '--refresh'])
+            index = scan_deps.git_index(checkout)
+            self.assertEqual(sorted(index), ['a.cpp', 'b.cpp'])
+            # A file changed after checkout is scanned again even with the same size
+            with open(os.path.join(checkout, 'b.cpp'), 'w') as f:
+                f.write('#include <boost/c.hpp>\n')
+            cache = scan_deps.ScanCache(cache_path)
+            self.assertEqual(cache.lookup('a.cpp', os.path.join(checkout, 'a.cpp'), index.get('a.cpp')),
+                             ['boost/a.hpp'])
+            self.assertIsNone(cache.lookup('b.cpp', os.path.join(checkout, 'b.cpp'), index.get('b.cpp')))
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class ExtensionsTest(unittest.TestCase):
+    def test_has_extension(self):
+        extensions = set(scan_deps.source_extensions)
+        for file in ['a.cpp', 'A.HPP', 'config.hpp.in', 'table.inc', 'impl.tcc', 'detail.ipp']:
+            self.assertTrue(scan_deps.has_extension(file, extensions), file)
+        for file in ['README.md', 'CMakeLists.txt', 'Makefile', '.clang-format', 'script.py', 'pch.hpp.gch',
+                     'foo.h.pch', 'a.cpp.o', 'a.cpp.obj', 'a.cpp.json', 'x.cpp.orig', 'notes.c.txt', 'file.in']:
+            self.assertFalse(scan_deps.has_extension(file, extensions), file)
+
+
+if __name__ == '__main__':
+    unittest.main()
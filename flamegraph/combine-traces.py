@@ -17,6 +17,10 @@ import argparse
 import json
 import os
 import re
+from bisect import bisect_right
+from heapq import heappop, heappush
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 # Logging partial results
 verbose = False
@@ -59,12 +63,175 @@ def load_compile_commands(directory):
         return json.load(f)
 
 
+def read_ninja_log(directory):
+    """Read the start and end times, in milliseconds, of each output of the last build in directory/.ninja_log."""
+    path = os.path.join(directory, '.ninja_log')
+    if not os.path.isfile(path):
+        return {}
+    outputs = {}
+    last_end = 0
+    with open(path, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 4:
+                continue
+            start, end, output = int(fields[0]), int(fields[1]), fields[3]
+            # The log is appended by each build, and times restart from zero in a new build
+            if end < last_end:
+                outputs = {}
+            last_end = end
+            outputs[output] = (start, end)
+    return outputs
+
+
+def ninja_tokens(line):
+    """Split the paths in a ninja build statement, with None in place of the ':' separator."""
+    if '$' not in line:
+        outputs, _, inputs = line.partition(':')
+        return outputs.split() + [None] + inputs.split()
+    tokens = []
+    token = ''
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if c == '$' and i + 1 < len(line):
+            token += line[i + 1]
+            i += 2
+            continue
+        if c == ' ' or c == ':':
+            if token:
+                tokens.append(token)
+                token = ''
+            if c == ':':
+                tokens.append(None)
+        else:
+            token += c
+        i += 1
+    if token:
+        tokens.append(token)
+    return tokens
+
+
+def read_ninja_graph(directory, filename='build.ninja', graph=None):
+    """Map each output in directory/build.ninja to the explicit, implicit and order-only inputs of its build statement."""
+    if graph is None:
+        graph = {}
+    path = os.path.join(directory, filename)
+    if not os.path.isfile(path):
+        return graph
+    with open(path, 'r') as f:
+        contents = f.read()
+    # Join continued lines
+    contents = re.sub(r'(?<!\$)((?:\$\$)*)\$\n[ \t]*', r'\1', contents)
+    for line in contents.splitlines():
+        if line.startswith('build '):
+            tokens = ninja_tokens(line[len('build '):])
+            if None not in tokens:
+                continue
+            separator = tokens.index(None)
+            outputs = [token for token in tokens[:separator] if token != '|']
+            inputs = []
+            for token in tokens[separator + 2:]:
+                if token == '|@':
+                    # Validations are not dependencies
+                    break
+                if token != '|' and token != '||':
+                    inputs.append(token)
+            for output in outputs:
+                graph[output] = inputs
+        elif line.startswith('include ') or line.startswith('subninja '):
+            read_ninja_graph(directory, line.split(None, 1)[1].strip(), graph)
+    return graph
+
+
+def critical_path(ninja_log, graph):
+    """Find the chain of build steps in ninja_log that determines the end of the build.
+
+    With the dependency graph, this is the chain of dependent steps with the longest
+    total duration. Without it, each step is assumed to have waited for the step that
+    finished last before it started.
+
+    Returns the outputs on the path in build order."""
+    if not ninja_log:
+        return []
+    outputs = sorted(ninja_log, key=lambda x: ninja_log[x][1])
+    predecessor = {}
+    if graph:
+        # Dependencies in the log, looking through steps that did not run, such as phony targets
+        logged_inputs = {}
+
+        def find_logged_inputs(node):
+            if node not in logged_inputs:
+                logged_inputs[node] = set()
+                result = set()
+                for input in graph.get(node, ()):
+                    if input in ninja_log:
+                        result.add(input)
+                    else:
+                        result |= find_logged_inputs(input)
+                logged_inputs[node] = result
+            return logged_inputs[node]
+
+        # Steps are visited after the steps they depend on, which finished before they started
+        finish = {}
+        for output in outputs:
+            start, end = ninja_log[output]
+            longest = 0
+            for input in find_logged_inputs(output):
+                if input in finish and finish[input] > longest:
+                    longest = finish[input]
+                    predecessor[output] = input
+            finish[output] = longest + end - start
+        last = max(outputs, key=lambda x: finish[x])
+    else:
+        ends = [ninja_log[output][1] for output in outputs]
+        for i, output in enumerate(outputs):
+            # The last step that finished before this one started
+            j = min(bisect_right(ends, ninja_log[output][0]) - 1, i - 1)
+            if j >= 0:
+                predecessor[output] = outputs[j]
+        last = outputs[-1]
+
+    path = [last]
+    while path[-1] in predecessor:
+        path.append(predecessor[path[-1]])
+    path.reverse()
+    return path
+
+
 def is_subpath(child_path, parent_path):
     child_path = os.path.abspath(child_path)
     parent_path = os.path.abspath(parent_path)
     return child_path.startswith(parent_path + '/')
 
 
+def compile_command_line(compile_command):
+    if 'command' in compile_command:
+        return compile_command['command']
+    return ' '.join(compile_command['arguments'])
+
+
+output_regex = re.compile(r'(?:^|\s)-o\s*([^\s]+)')
+
+
+def index_compile_commands(compile_commands, build_dir):
+    """Map each object file, relative to the build directory and without its extension, to its source file."""
+    index = {}
+    for compile_command in compile_commands:
+        output = compile_command.get('output')
+        if output is None:
+            m = output_regex.search(compile_command_line(compile_command))
+            if not m:
+                continue
+            output = m.group(1)
+        directory = compile_command.get('directory', build_dir)
+        output = os.path.relpath(os.path.join(directory, output), build_dir)
+        index.setdefault(os.path.splitext(output)[0], os.path.join(directory, compile_command['file']))
+    return index
+
+
 def extract_include_paths(command):
     include_paths = []
 
@@ -96,12 +263,518 @@ def format_time(microseconds):
         hours = round(microseconds / 3600000000, 2)
         return f"{hours} h"
 
+class PathResolver:
+    """Normalizes the file paths in event details, resolving each unique detail only once.
+
+    Paths in the source or build directories are made relative to them. Other
+    paths are made relative to the first include path containing them, found by
+    looking up each ancestor directory in an index of the include paths."""
+
+    def __init__(self, source_dir, build_dir, include_paths):
+        self.source_dir = source_dir
+        self.build_dir = build_dir
+        # include path -> position in include_paths, which gives its precedence
+        self.include_index = {}
+        for i, include_path in enumerate(include_paths):
+            self.include_index.setdefault(os.path.abspath(include_path), i)
+        self.cache = {}
+
+    def __call__(self, detail):
+        if detail in self.cache:
+            return self.cache[detail]
+        path = detail
+        if os.path.exists(detail):
+            path = os.path.abspath(detail)
+            if is_subpath(path, self.source_dir):
+                path = os.path.relpath(path, self.source_dir)
+            elif is_subpath(path, self.build_dir):
+                path = os.path.relpath(path, self.build_dir)
+            else:
+                include_path = self.find_include_path(path)
+                if include_path is not None:
+                    path = os.path.relpath(path, include_path)
+        self.cache[detail] = path
+        return path
+
+    def find_include_path(self, path):
+        best = None
+        parent = os.path.dirname(path)
+        while parent != os.path.dirname(parent):
+            i = self.include_index.get(parent)
+            if i is not None and (best is None or i < best[0]):
+                best = (i, parent)
+            parent = os.path.dirname(parent)
+        return None if best is None else best[1]
+
+
+def uncovered_totals(regions):
+    """Count and total duration of the regions that do not start inside a region already counted.
+
+    regions is a list of (ts, dur, always), where regions with always set are counted even
+    when they start inside another region. The regions are visited in a single sweep sorted
+    by start time, with longer regions first, so a region is counted before the regions
+    nested in it and checking whether a region starts inside a counted one only needs the
+    furthest end of the counted regions so far."""
+    count = 0
+    time = 0
+    covered_end = None
+    for ts, dur, always in sorted(regions, key=lambda x: (x[0], -x[1])):
+        if always or covered_end is None or ts >= covered_end:
+            count += 1
+            time += dur
+            covered_end = ts + dur if covered_end is None else max(covered_end, ts + dur)
+    return count, time
+
+
+def parse_min_duration(value):
+    """Parse a minimum event duration in microseconds, or in percent of the translation unit if it ends with '%'.
+
+    Returns a (duration, relative) pair."""
+    value = value.strip()
+    relative = value.endswith('%')
+    if relative:
+        value = value[:-1]
+    try:
+        duration = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid minimum duration: {value!r}')
+    if duration < 0:
+        raise argparse.ArgumentTypeError(f'minimum duration cannot be negative: {value!r}')
+    return duration, relative
+
+
+def filter_short_events(events, min_duration, collapse):
+    """Remove complete events shorter than min_duration from the events of a translation unit.
+
+    Events nested in a removed event are removed with it. If collapse is True, each run
+    of consecutive removed children of the same event is replaced with a single
+    synthetic "Other" event with their total duration, so the parent time is still
+    accounted for in the flamegraph."""
+    kept = [event for event in events if 'dur' not in event]
+    others = []
+    # Events that contain the current event, as [end, event, is_kept, current "Other" run]
+    stack = []
+    for event in sorted((event for event in events if 'dur' in event), key=lambda x: (x['ts'], -x['dur'])):
+        ts = event['ts']
+        dur = event['dur']
+        while stack and stack[-1][0] <= ts:
+            stack.pop()
+        parent = stack[-1] if stack else None
+        if dur >= min_duration or event['name'] == 'ExecuteCompiler':
+            kept.append(event)
+            if parent is not None:
+                # A kept child ends the run of removed siblings
+                parent[3] = None
+            stack.append([ts + dur, event, True, None])
+            continue
+
+        if parent is not None and not parent[2]:
+            # Already accounted for in the removed parent
+            continue
+        stack.append([ts + dur, event, False, None])
+        if not collapse or parent is None:
+            continue
+        other = parent[3]
+        if other is None:
+            other = {'name': 'Other', 'cat': 'Other', 'ph': 'X', 'ts': ts, 'dur': 0, 'pid': event['pid'],
+                     'tid': event['tid'], 'args': {'count': 0}}
+            others.append(other)
+            parent[3] = other
+        other['dur'] += dur
+        other['args']['count'] += 1
+
+    # Keep the original event order and add the synthetic events at the end
+    kept_ids = set(id(event) for event in kept)
+    return [event for event in events if id(event) in kept_ids] + others
+
+
+class TraceWriter:
+    """Writes the combined events to a file in timestamp order while they are being produced.
+
+    Events wait in a heap only until no later event can precede them, so the whole
+    combined trace is never held in memory. Ties keep the order in which events were
+    added, as in a stable sort of all events."""
+
+    def __init__(self, f):
+        self.f = f
+        self.heap = []
+        self.n_added = 0
+        self.n_written = 0
+        self.f.write('{"traceEvents": [')
+
+    def add(self, events):
+        for event in events:
+            heappush(self.heap, (event['ts'], self.n_added, event))
+            self.n_added += 1
+
+    def flush(self, ts=None):
+        # Write all events up to ts, or all events if ts is None
+        while self.heap and (ts is None or self.heap[0][0] <= ts):
+            event = heappop(self.heap)[2]
+            if self.n_written:
+                self.f.write(', ')
+            self.f.write(json.dumps(event))
+            self.n_written += 1
+
+    def close(self):
+        self.flush()
+        self.f.write(']}')
+
+
+def trace_object_file(trace_file, build_dir):
+    # foo.cpp.json is generated next to foo.cpp.o
+    return os.path.relpath(trace_file, build_dir)[:-len('.json')] + '.o'
+
+
+def ninja_timeline(trace_files, build_dir):
+    """Find the (start, end) interval of each trace file in microseconds from .ninja_log.
+
+    Returns None unless all trace files are in the log of the last build."""
+    ninja_log = read_ninja_log(build_dir)
+    timeline = []
+    for trace_file in trace_files:
+        interval = ninja_log.get(trace_object_file(trace_file, build_dir))
+        if interval is None:
+            return None
+        timeline.append((interval[0] * 1000, interval[1] * 1000))
+    return timeline
+
+
+def object_file_timeline(trace_files, total_times):
+    """Find the (start, end) interval of each trace file in microseconds from the object file modification time.
+
+    The compilation is assumed to end when the object file is written."""
+    timeline = []
+    for trace_file, total_time in zip(trace_files, total_times):
+        end = os.stat(trace_file[:-len('.json')] + '.o').st_mtime_ns // 1000
+        timeline.append((end - (total_time or 0), end))
+    return timeline
+
+
+def assign_lanes(timeline):
+    """Assign each interval to the lowest lane that is free when it starts, as a build worker would.
+
+    The intervals should be sorted by start time."""
+    lanes = []
+    busy = []
+    free = []
+    for start, end in timeline:
+        while busy and busy[0][0] <= start:
+            heappush(free, heappop(busy)[1])
+        lane = heappop(free) if free else len(busy)
+        heappush(busy, (end, lane))
+        lanes.append(lane)
+    return lanes
+
+
+def new_trace_stats():
+    return {
+        # (count, time) totals
+        'compile': (0, 0),
+        # Frontend: parsing and instantiations
+        'frontend': (0, 0),
+        'parsing': (0, 0),
+        'instantiations': (0, 0),
+        # Backend: code generation and optimizations
+        'backend': (0, 0),
+        'codegen': (0, 0),
+        'optimize': (0, 0),
+        # Individual files and symbols
+        'file_compile': {},
+        'file_parse': {},
+        'symbol_parse': {},
+        'symbol_instantiate': {},
+        # Headers: (including TUs, inclusive time, exclusive time)
+        'header_cost': {},
+        # Instantiations: (count, inclusive time, exclusive time)
+        'instantiation_cost': {},
+        # Instantiations not nested in other instantiations: (count, time, nested instantiations)
+        'instantiation_roots': {},
+    }
+
+
+def merge_trace_stats(stats, other):
+    for key, value in other.items():
+        if type(value) == tuple:
+            stats[key] = (stats[key][0] + value[0], stats[key][1] + value[1])
+        else:
+            for k, v in value.items():
+                if k not in stats[key]:
+                    stats[key][k] = v
+                else:
+                    stats[key][k] = tuple(a + b for a, b in zip(stats[key][k], v))
+
+
+def nested_costs(intervals):
+    """Rebuild the nesting of the intervals of a translation unit with a single sorted sweep.
+
+    intervals is a list of (ts, dur, name). The inclusive time of a name includes the
+    intervals nested in it, while the exclusive time does not. Nested intervals with the
+    same name as an enclosing interval are not counted twice in the inclusive time.
+
+    Returns a dict name -> (count, inclusive, exclusive) and a dict with the intervals
+    that are not nested in any other, name -> (count, time, number of nested intervals)."""
+    costs = {}
+    roots = {}
+    # Intervals that contain the current one, as [end, name, dur, time in nested intervals, number of nested intervals]
+    stack = []
+    # Names in the stack
+    open_names = {}
+
+    def pop():
+        [_, name, dur, nested, n_nested] = stack.pop()
+        open_names[name] -= 1
+        [count, inclusive, exclusive] = costs.get(name, (0, 0, 0))
+        if not open_names[name]:
+            inclusive += dur
+        costs[name] = (count + 1, inclusive, exclusive + dur - nested)
+        if stack:
+            stack[-1][4] += n_nested + 1
+        else:
+            [count, time, descendants] = roots.get(name, (0, 0, 0))
+            roots[name] = (count + 1, time + dur, descendants + n_nested)
+
+    for ts, dur, name in sorted(intervals, key=lambda x: (x[0], -x[1])):
+        while stack and stack[-1][0] <= ts:
+            pop()
+        if stack:
+            stack[-1][3] += dur
+        stack.append([ts + dur, name, dur, 0, 0])
+        open_names[name] = open_names.get(name, 0) + 1
+    while stack:
+        pop()
+    return costs, roots
+
+
+# Context shared by all trace files, set in each worker process by init_trace_context
+trace_context = {}
+
+
+def init_trace_context(source_dir, build_dir, compile_commands, compile_commands_index, include_paths, verbose_mode,
+                       min_duration=(0, False), collapse=False):
+    global verbose
+    verbose = verbose_mode
+    trace_context['min_duration'] = min_duration
+    trace_context['collapse'] = collapse
+    trace_context['source_dir'] = source_dir
+    trace_context['build_dir'] = build_dir
+    trace_context['compile_commands'] = compile_commands
+    trace_context['compile_commands_index'] = compile_commands_index
+    trace_context['include_paths'] = include_paths
+    trace_context['resolve_path'] = PathResolver(source_dir, build_dir, include_paths)
+
+
+def process_trace_file(trace_file):
+    """Load, aggregate and adjust the events of a single time-trace file.
+
+    Returns the translation unit name, its adjusted events, the time the whole
+    file took to compile, and its report data."""
+    source_dir = trace_context['source_dir']
+    build_dir = trace_context['build_dir']
+    compile_commands = trace_context['compile_commands']
+    compile_commands_index = trace_context['compile_commands_index']
+    resolve_path = trace_context['resolve_path']
+    stats = new_trace_stats()
+    file_compile = stats['file_compile']
+    file_parse = stats['file_parse']
+    symbol_parse = stats['symbol_parse']
+    symbol_instantiate = stats['symbol_instantiate']
+    sources = []
+    instantiations = []
+
+    # Load one trace at a time, so peak memory is bounded by the largest trace file
+    # rather than by the sum of all of them
+    with open(trace_file, 'r') as f:
+        trace = json.load(f)
+
+    # Adjust filename
+    filename = os.path.relpath(trace_file, build_dir)
+    filename = filename[:-5]
+    if filename in compile_commands_index:
+        filename = os.path.relpath(compile_commands_index[filename], source_dir)
+    else:
+        # Commands whose output could not be determined
+        for compile_command in compile_commands:
+            if compile_command_line(compile_command).find(filename) != -1:
+                filename = compile_command['file']
+                filename = os.path.relpath(filename, source_dir)
+                break
+    filename = filename.replace('CMakeFiles/', '')
+    segments = filename.split('/')
+    segments = [f'{{{segment[:-4]}}}' if segment.endswith('.dir') else segment for segment in segments]
+    filename = '/'.join(segments)
+    if filename.find('../') != -1:
+        filename = os.path.abspath(filename)
+
+    # regions accounted for in the parsing and instantiation totals
+    parsing_regions = []
+    instantiation_regions = []
+
+    sorted_events = sorted(trace['traceEvents'], key=lambda x: 0 if 'dur' not in x else int(x['dur']), reverse=True)
+    # Release the parsed file as soon as its events are sorted
+    del trace
+    events = []
+    file_total_time = None
+    for event in sorted_events:
+        # Filter out very short events to reduce data size
+        event_is_too_short = event['ph'] == 'M' or event['name'].startswith('Total')
+        if event_is_too_short:
+            continue
+
+        # log('Event:', event)
+        # Adjust detail path
+        if 'args' in event and 'detail' in event['args']:
+            if type(event['args']['detail']) == str:
+                event['args']['detail'] = resolve_path(event['args']['detail'])
+
+        # Store data for the report
+        if event['name'] == 'Source':
+            # add to total
+            ts = int(event['ts'])
+            dur = int(event['dur'])
+            parsing_regions.append((ts, dur, False))
+
+            # add to files total
+            file = event['args']['detail']
+            if file not in file_parse:
+                file_parse[file] = (0, 0)
+            file_parse[file] = (file_parse[file][0] + 1, file_parse[file][1] + dur)
+            sources.append((ts, dur, file))
+
+        elif event['name'].startswith('Parse') and 'args' in event and 'detail' in event['args']:
+            # add to symbols total
+            dur = int(event['dur'])
+            symbol = event['args']['detail']
+            if symbol not in symbol_parse:
+                symbol_parse[symbol] = (0, 0)
+            symbol_parse[symbol] = (symbol_parse[symbol][0] + 1, symbol_parse[symbol][1] + dur)
+
+        elif event['name'].startswith('Instantiate') and 'args' in event and 'detail' in event['args']:
+            # add to total
+            ts = int(event['ts'])
+            dur = int(event['dur'])
+            instantiation_regions.append((ts, dur, False))
+
+            # add to symbol total
+            symbol = event['args']['detail']
+            if symbol not in symbol_instantiate:
+                symbol_instantiate[symbol] = (0, 0)
+            symbol_instantiate[symbol] = (symbol_instantiate[symbol][0] + 1, symbol_instantiate[symbol][1] + dur)
+            instantiations.append((ts, dur, symbol))
+
+        elif event['name'] == 'PerformPendingInstantiations':
+            ts = int(event['ts'])
+            dur = int(event['dur'])
+            instantiation_regions.append((ts, dur, True))
+
+        elif event['name'] == 'Frontend':
+            stats['frontend'] = (stats['frontend'][0] + 1, stats['frontend'][1] + int(event['dur']))
+        elif event['name'] == 'Backend':
+            stats['backend'] = (stats['backend'][0] + 1, stats['backend'][1] + int(event['dur']))
+        elif event['name'] == 'Optimizer':
+            stats['optimize'] = (stats['optimize'][0] + 1, stats['optimize'][1] + int(event['dur']))
+        elif event['name'] == 'CodeGenPasses':
+            stats['codegen'] = (stats['codegen'][0] + 1, stats['codegen'][1] + int(event['dur']))
+        elif event['name'] == 'ExecuteCompiler':
+            # add to total
+            ts = int(event['ts'])
+            dur = int(event['dur'])
+            stats['compile'] = (stats['compile'][0] + 1, stats['compile'][1] + dur)
+
+            # add to files total
+            if filename not in file_compile:
+                file_compile[filename] = (0, 0)
+            file_compile[filename] = (file_compile[filename][0] + 1, file_compile[filename][1] + dur)
+
+        # Keep track of the main ExecuteCompiler event, which exists for each file
+        # Also adapt this event to include the file name
+        if event['name'] == 'ExecuteCompiler':
+            # Find how long this compilation took for this file
+            # This represents how long the whole object file took
+            # and can be used to shift the start time for the next file
+            file_total_time = event['dur']
+            log(f'{filename} took {format_time(file_total_time)}')
+            # Set the file name in ExecuteCompiler
+            if 'args' not in event:
+                event['args'] = {}
+            event['args']['detail'] = filename
+
+        # Replace source event names with filename
+        if event['name'] == 'Source':
+            if 'args' in event and 'detail' in event['args']:
+                event['name'] = event['args']['detail']
+            else:
+                event['name'] = filename
+            event['cat'] = 'Source'
+
+        # Put all events in the same pid
+        # Different pids tend to be rendered in different tabs in some
+        # visualizers, which is not what we want
+        event['pid'] = 0
+        event['tid'] = 0
+
+        events.append(event)
+
+    # Nested regions are only counted once in the totals
+    stats['parsing'] = uncovered_totals(parsing_regions)
+    stats['instantiations'] = uncovered_totals(instantiation_regions)
+
+    header_cost, _ = nested_costs(sources)
+    stats['header_cost'] = {header: (1, inclusive, exclusive) for header, [_, inclusive, exclusive] in header_cost.items()}
+    stats['instantiation_cost'], stats['instantiation_roots'] = nested_costs(instantiations)
+
+    # Remove short events from the output only, after they have been included in the report data
+    min_duration, relative = trace_context['min_duration']
+    if relative:
+        longest = file_total_time if file_total_time is not None else max(
+            (event['dur'] for event in events if 'dur' in event), default=0)
+        min_duration = longest * min_duration / 100
+    if min_duration > 0:
+        n_events = len(events)
+        events = filter_short_events(events, min_duration, trace_context['collapse'])
+        log(f'{filename}: {n_events - len(events)} events shorter than {format_time(min_duration)} removed')
+
+    return filename, events, file_total_time, stats
+
+
+def map_trace_files(trace_files, jobs, context):
+    """Process the trace files in order, in a pool of jobs processes if jobs > 1."""
+    if jobs > 1 and len(trace_files) > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_trace_context, initargs=context) as executor:
+            # Results are consumed in order, so the timeline is the same as in a serial run.
+            # Only a window of 2 * jobs files is submitted ahead of the file being consumed,
+            # so finished results do not pile up in memory while an earlier file is still running.
+            window = 2 * jobs
+            futures = deque()
+            for trace_file in trace_files:
+                futures.append(executor.submit(process_trace_file, trace_file))
+                if len(futures) >= window:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+    else:
+        init_trace_context(*context)
+        for trace_file in trace_files:
+            yield process_trace_file(trace_file)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Installs the dependencies needed to test a Boost library.')
     parser.add_argument('--source-dir', help="directory to scan", default=os.getcwd())
     parser.add_argument('--build-dir', help="directory to scan", default=os.getcwd())
     parser.add_argument('-o', '--output', help="output file", default='combined-traces.json')
     parser.add_argument('--report-output', help="output file", default='time-trace-report.md')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of processes processing trace files; 0 uses all available cores")
+    parser.add_argument('--min-duration', type=parse_min_duration, default=(0, False),
+                        help="omit events shorter than this from the combined trace, in microseconds or in percent "
+                             "of the translation unit time if it ends with '%%' (e.g. 500 or 0.5%%)")
+    parser.add_argument('--collapse-short', action='store_true',
+                        help="replace events omitted by --min-duration with synthetic \"Other\" events")
+    parser.add_argument('--layout', choices=['serial', 'parallel'], default='serial',
+                        help="'serial' places translation units one after the other; 'parallel' places them at "
+                             "their real build times from .ninja_log, or the object file times, on one lane per "
+                             "build worker")
     parser.add_argument('--verbose', action='store_true', help="Verbose mode")
     args = parser.parse_args()
 
@@ -110,26 +783,20 @@ if __name__ == '__main__':
     output_path = os.path.join(build_dir, args.output)
     report_path = os.path.join(build_dir, args.report_output)
     verbose = args.verbose
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
 
     # Find trace files
     trace_files = find_trace_files(build_dir)
     log(f'{len(trace_files)} trace files')
     log([os.path.relpath(trace_file, build_dir) for trace_file in trace_files])
 
-    # Open trace files
-    traces = []
-    for filename in trace_files:
-        with open(filename, 'r') as f:
-            traces.append((filename, json.load(f)))
-    log('Time-trace files loaded')
-
     # Find CMake compile_commands.json
     compile_commands = load_compile_commands(build_dir)
 
     # Include dirs used in compilation, so we can determine which are reasonable relative paths for files
     include_paths = []
     for compile_command in compile_commands:
-        include_paths += extract_include_paths(compile_command['command'])
+        include_paths += extract_include_paths(compile_command_line(compile_command))
     PATH = os.getenv('PATH')
     if PATH:
         include_paths += PATH.split(':')
@@ -137,183 +804,91 @@ if __name__ == '__main__':
     include_paths.append('/usr/local/include')
     include_paths.append('/usr/include/c++')
 
-    # Report data
-    total_compile: {int} = (0, 0)
-    # Frontend: parsing and instantiations
-    total_frontend: {int} = (0, 0)
-    total_parsing: {int} = (0, 0)
-    total_instantiations: {int} = (0, 0)
-    # Backend: code generation and optimizations
-    total_backend: {int} = (0, 0)
-    total_codegen: {int} = (0, 0)
-    total_optimize: {int} = (0, 0)
-    # Individual files and symbols
-    file_compile: {str, tuple} = {}
-    file_parse: {str, tuple} = {}
-    symbol_parse: {str, tuple} = {}
-    symbol_instantiate: {str, tuple} = {}
-
     # Combine time-trace content
+    stats = new_trace_stats()
     start_time = 0
-    combined_data = []
     file_total_time = 0
-    for [filename, trace] in traces:
-        # Adjust filename
-        filename = os.path.relpath(filename, build_dir)
-        filename = filename[:-5]
-        for compile_command in compile_commands:
-            if compile_command['command'].find(filename) != -1:
-                filename = compile_command['file']
-                filename = os.path.relpath(filename, source_dir)
-                break
-        filename = filename.replace('CMakeFiles/', '')
-        segments = filename.split('/')
-        segments = [f'{{{segment[:-4]}}}' if segment.endswith('.dir') else segment for segment in segments]
-        filename = '/'.join(segments)
-        if filename.find('../') != -1:
-            filename = os.path.abspath(filename)
-
-        # regions already accounted for
-        parsing_regions = []
-        instantiation_regions = []
-
-        sorted_events = sorted(trace['traceEvents'], key=lambda x: 0 if 'dur' not in x else int(x['dur']), reverse=True)
-        for event in sorted_events:
-            # Filter out very short events to reduce data size
-            event_is_too_short = event['ph'] == 'M' or event['name'].startswith('Total')
-            if event_is_too_short:
+    compile_commands_index = index_compile_commands(compile_commands, build_dir)
+    context = (source_dir, build_dir, compile_commands, compile_commands_index, include_paths, verbose,
+               args.min_duration, args.collapse_short)
+    results = map_trace_files(trace_files, jobs, context)
+    timeline = None
+    if args.layout == 'parallel':
+        timeline = ninja_timeline(trace_files, build_dir)
+        if timeline is not None:
+            log('Build times from .ninja_log')
+            order = sorted(range(len(trace_files)), key=lambda i: timeline[i])
+            trace_files = [trace_files[i] for i in order]
+            timeline = [timeline[i] for i in order]
+            results = map_trace_files(trace_files, jobs, context)
+        else:
+            # The start times depend on the compile times, so all traces are loaded first
+            log('Build times from object files')
+            results = list(results)
+            timeline = object_file_timeline(trace_files, [result[2] for result in results])
+            order = sorted(range(len(trace_files)), key=lambda i: timeline[i])
+            results = [results[i] for i in order]
+            timeline = [timeline[i] for i in order]
+        lanes = assign_lanes(timeline)
+        origin = min((interval[0] for interval in timeline), default=0)
+        log(f'{max(lanes, default=-1) + 1} build workers')
+    with open(output_path, 'w') as f:
+        writer = TraceWriter(f)
+        if timeline is not None:
+            for lane in sorted(set(lanes)):
+                writer.add([{'ph': 'M', 'name': 'thread_name', 'ts': 0, 'pid': 0, 'tid': lane,
+                             'args': {'name': f'Worker {lane}'}}])
+        for i, [filename, events, trace_total_time, trace_stats] in enumerate(results):
+            merge_trace_stats(stats, trace_stats)
+            if trace_total_time is not None:
+                file_total_time = trace_total_time
+
+            if timeline is not None:
+                # Offset by the build start time and place the file in the lane of its worker
+                for event in events:
+                    event['ts'] += timeline[i][0] - origin
+                    event['tid'] = lanes[i]
+                writer.add(events)
+                del events
+
+                # Files are sorted by start time, so earlier events can be written
+                if i + 1 < len(timeline):
+                    writer.flush(timeline[i + 1][0] - origin)
                 continue
 
-            # log('Event:', event)
-            # Adjust detail path
-            if 'args' in event and 'detail' in event['args']:
-                if type(event['args']['detail']) == str:
-                    if os.path.exists(event['args']['detail']):
-                        event['args']['detail'] = os.path.abspath(event['args']['detail'])
-                        if is_subpath(event['args']['detail'], source_dir):
-                            event['args']['detail'] = os.path.relpath(event['args']['detail'], source_dir)
-                        elif is_subpath(event['args']['detail'], build_dir):
-                            event['args']['detail'] = os.path.relpath(event['args']['detail'], build_dir)
-                        else:
-                            for include_path in include_paths:
-                                if is_subpath(event['args']['detail'], include_path):
-                                    event['args']['detail'] = os.path.relpath(event['args']['detail'], include_path)
-                                    break
-
-            # Store data for the report
-            if event['name'] == 'Source':
-                # add to total
-                ts = int(event['ts'])
-                dur = int(event['dur'])
-                accounted_for = False
-                for parsing_region in parsing_regions:
-                    if parsing_region[0] <= ts < parsing_region[1]:
-                        accounted_for = True
-                        break
-                if not accounted_for:
-                    total_parsing = (total_parsing[0] + 1, total_parsing[1] + dur)
-                    parsing_regions.append((ts, ts + dur))
-
-                # add to files total
-                file = event['args']['detail']
-                if file not in file_parse:
-                    file_parse[file] = (0, 0)
-                file_parse[file] = (file_parse[file][0] + 1, file_parse[file][1] + dur)
-
-            elif event['name'].startswith('Parse') and 'args' in event and 'detail' in event['args']:
-                # add to symbols total
-                dur = int(event['dur'])
-                symbol = event['args']['detail']
-                if symbol not in symbol_parse:
-                    symbol_parse[symbol] = (0, 0)
-                symbol_parse[symbol] = (symbol_parse[symbol][0] + 1, symbol_parse[symbol][1] + dur)
-
-            elif event['name'].startswith('Instantiate') and 'args' in event and 'detail' in event['args']:
-                # add to total
-                ts = int(event['ts'])
-                dur = int(event['dur'])
-                accounted_for = False
-                for instantiation_region in instantiation_regions:
-                    if instantiation_region[0] <= ts < instantiation_region[1]:
-                        accounted_for = True
-                        break
-                if not accounted_for:
-                    total_instantiations = (total_instantiations[0] + 1, total_instantiations[1] + dur)
-                    instantiation_regions.append((ts, ts + dur))
-
-                # add to symbol total
-                symbol = event['args']['detail']
-                if symbol not in symbol_instantiate:
-                    symbol_instantiate[symbol] = (0, 0)
-                symbol_instantiate[symbol] = (symbol_instantiate[symbol][0] + 1, symbol_instantiate[symbol][1] + dur)
-
-            elif event['name'] == 'PerformPendingInstantiations':
-                ts = int(event['ts'])
-                dur = int(event['dur'])
-                total_instantiations = (total_instantiations[0] + 1, total_instantiations[1] + dur)
-                instantiation_regions.append((ts, ts + dur))
-
-            elif event['name'] == 'Frontend':
-                total_frontend = (total_frontend[0] + 1, total_frontend[1] + int(event['dur']))
-            elif event['name'] == 'Backend':
-                total_backend = (total_backend[0] + 1, total_backend[1] + int(event['dur']))
-            elif event['name'] == 'Optimizer':
-                total_optimize = (total_optimize[0] + 1, total_optimize[1] + int(event['dur']))
-            elif event['name'] == 'CodeGenPasses':
-                total_codegen = (total_codegen[0] + 1, total_codegen[1] + int(event['dur']))
-            elif event['name'] == 'ExecuteCompiler':
-                # add to total
-                ts = int(event['ts'])
-                dur = int(event['dur'])
-                total_compile = (total_compile[0] + 1, total_compile[1] + dur)
-
-                # add to files total
-                if filename not in file_compile:
-                    file_compile[filename] = (0, 0)
-                file_compile[filename] = (file_compile[filename][0] + 1, file_compile[filename][1] + dur)
-
-            # Keep track of the main ExecuteCompiler event, which exists for each file
-            # Also adapt this event to include the file name
-            if event['name'] == 'ExecuteCompiler':
-                # Find how long this compilation took for this file
-                # This represents how long the whole object file took
-                # and can be used to shift the start time for the next file
-                file_total_time = event['dur']
-                log(f'{filename} took {format_time(file_total_time)}')
-                # Set the file name in ExecuteCompiler
-                if 'args' not in event:
-                    event['args'] = {}
-                event['args']['detail'] = filename
-
-            # Replace source event names with filename
-            if event['name'] == 'Source':
-                if 'args' in event and 'detail' in event['args']:
-                    event['name'] = event['args']['detail']
-                else:
-                    event['name'] = filename
-                event['cat'] = 'Source'
-
             # Offset by start time to make events sequential in a single timeline
-            event['ts'] += start_time
-
-            # Put all events in the same pid
-            # Different pids tend to be rendered in different tabs in some
-            # visualizers, which is not what we want
-            event['pid'] = 0
-            event['tid'] = 0
-
-            # Add data to combined
-            combined_data.append(event)
-
-        # Increase the start time for the next file
-        # Add 1 to avoid issues with simultaneous events
-        start_time += file_total_time + 1
-
-    with open(output_path, 'w') as f:
-        json.dump({'traceEvents': sorted(combined_data, key=lambda k: k['ts'])}, f)
+            for event in events:
+                event['ts'] += start_time
+            writer.add(events)
+            del events
+
+            # Increase the start time for the next file
+            # Add 1 to avoid issues with simultaneous events
+            start_time += file_total_time + 1
+
+            # Events of the next files start after start_time, so earlier events can be written
+            writer.flush(start_time)
+        writer.close()
+        log('Time-trace files processed')
         log('Saved to ', os.path.abspath(output_path))
 
 
+    # Report data
+    total_compile = stats['compile']
+    total_frontend = stats['frontend']
+    total_parsing = stats['parsing']
+    total_instantiations = stats['instantiations']
+    total_backend = stats['backend']
+    total_codegen = stats['codegen']
+    total_optimize = stats['optimize']
+    file_compile = stats['file_compile']
+    file_parse = stats['file_parse']
+    symbol_parse = stats['symbol_parse']
+    symbol_instantiate = stats['symbol_instantiate']
+    header_cost = stats['header_cost']
+    instantiation_cost = stats['instantiation_cost']
+    instantiation_roots = stats['instantiation_roots']
+
     # Report
     output = '# Time Trace\n\n'
     output += '## Summary\n\n'
@@ -335,6 +910,36 @@ if __name__ == '__main__':
         output += f'| 2B) Optimization   | {round(100 * total_optimize[1] / total_compile[1], 2)}% | {format_time(total_optimize[1])} | {format_time(total_optimize[1] / total_optimize[0])} | {total_optimize[0]} |\n'
     output += '\n\n'
 
+    # Build steps that determine the wall-clock build time
+    ninja_log = read_ninja_log(build_dir)
+    if ninja_log:
+        ninja_graph = read_ninja_graph(build_dir)
+        path = critical_path(ninja_log, ninja_graph)
+        build_start = min(start for start, _ in ninja_log.values())
+        build_time = (max(end for _, end in ninja_log.values()) - build_start) * 1000
+        path_time = sum(ninja_log[step][1] - ninja_log[step][0] for step in path) * 1000
+        output += '## Critical Path\n\n'
+        if ninja_graph:
+            output += 'Chain of dependent build steps with the longest total duration in `.ninja_log`.\n\n'
+        else:
+            output += 'Chain of build steps reconstructed from `.ninja_log` times, where each step waits for the last step that finished before it started.\n\n'
+        output += f'The build took {format_time(build_time)} and the steps in the critical path took {format_time(path_time)}.\n\n'
+        output += '| Step | Kind | Start | Duration | % |\n'
+        output += '| ---- | ---- | ----- | -------- | ----- |\n'
+        for step in path:
+            [start, end] = ninja_log[step]
+            object_file = os.path.splitext(os.path.normpath(step))[0]
+            if object_file in compile_commands_index:
+                kind = 'Compile'
+                name = os.path.relpath(compile_commands_index[object_file], source_dir)
+            else:
+                extension = os.path.splitext(step)[1]
+                kind = 'Link' if extension in ['', '.a', '.so', '.dylib', '.lib', '.dll', '.exe'] or '.so.' in step else 'Other'
+                name = step
+            percent = round(100 * (end - start) * 1000 / build_time, 2) if build_time else 0
+            output += f'| `{name}` | {kind} | {format_time((start - build_start) * 1000)} | {format_time((end - start) * 1000)} | {percent}% |\n'
+        output += '\n\n'
+
     output += '## Files\n\n'
 
 
@@ -378,6 +983,32 @@ if __name__ == '__main__':
     output += '### Parse\n\n'
     output += section_table('File', file_parse)
 
+    def rows_table(columns, rows):
+        # Same layout as section_table for rows with other columns
+        def table(rows):
+            table_output = '| ' + ' | '.join(columns) + ' |\n'
+            table_output += '| ' + ' | '.join('-' * max(5, len(column)) for column in columns) + ' |\n'
+            for row in rows:
+                table_output += f'| `{row[0]}` | ' + ' | '.join(row[1:]) + ' |\n'
+            table_output += '\n\n'
+            return table_output
+
+        section_output = table(rows[:8])
+        if len(rows) > 8:
+            section_output += '<details>\n<summary>More...</summary>\n\n'
+            section_output += table(rows[:101])
+            section_output += '</details>\n\n'
+        return section_output
+
+    # A precompiled header is parsed once instead of once per translation unit. The
+    # estimate does not include the time to load the precompiled header.
+    header_saving = sorted(header_cost.items(), key=lambda x: x[1][1] - x[1][1] / x[1][0], reverse=True)
+    output += '### Headers\n\n'
+    output += 'Estimated saving if the header is moved into a precompiled header or module, so it is parsed once rather than in each translation unit.\n\n'
+    output += rows_table(['Header', 'TUs', 'Inclusive Time', 'Exclusive Time', 'Est. Saving'], [
+        [header, str(count), format_time(inclusive), format_time(exclusive), format_time(inclusive - inclusive / count)]
+        for [header, [count, inclusive, exclusive]] in header_saving])
+
     output += '## Symbols\n\n'
 
     output += '### Parse\n\n'
@@ -414,6 +1045,24 @@ if __name__ == '__main__':
             symbol_set_instantiate[symbol_set][0] + count, symbol_set_instantiate[symbol_set][1] + time)
     output += section_table('Symbol Set', symbol_set_instantiate)
 
+    # Instantiations rebuilt as a tree, so nested instantiations are not counted twice
+    def instantiation_tree_tables(instantiation_cost, instantiation_roots):
+        section_output = '### Instantiation Root Causes\n\n'
+        section_output += 'Instantiations that are not nested in other instantiations, with the time of all instantiations they trigger.\n\n'
+        roots = sorted(instantiation_roots.items(), key=lambda x: x[1][1], reverse=True)
+        section_output += rows_table(['Symbol', 'Total Time', 'Avg.', 'Nested Instantiations', 'Count'], [
+            [symbol, format_time(time), format_time(time / count), str(descendants), str(count)]
+            for [symbol, [count, time, descendants]] in roots])
+        section_output += '### Instantiate Exclusive\n\n'
+        section_output += 'Time of each instantiation excluding the instantiations nested in it.\n\n'
+        costs = sorted(instantiation_cost.items(), key=lambda x: x[1][2], reverse=True)
+        section_output += rows_table(['Symbol', 'Exclusive Time', 'Inclusive Time', 'Count'], [
+            [symbol, format_time(exclusive), format_time(inclusive), str(count)]
+            for [symbol, [count, inclusive, exclusive]] in costs])
+        return section_output
+
+    output += instantiation_tree_tables(instantiation_cost, instantiation_roots)
+
 
     def is_std_symbol(symbol):
         return symbol.startswith('std::') or symbol.startswith('__gnu_cxx::')
@@ -428,6 +1077,9 @@ if __name__ == '__main__':
     output += '### Instantiate Sets\n\n'
     symbol_set_instantiate = {k: v for k, v in symbol_set_instantiate.items() if not is_std_symbol(k)}
     output += section_table('Symbol Set', symbol_set_instantiate)
+    instantiation_cost = {k: v for k, v in instantiation_cost.items() if not is_std_symbol(k)}
+    instantiation_roots = {k: v for k, v in instantiation_roots.items() if not is_std_symbol(k)}
+    output += instantiation_tree_tables(instantiation_cost, instantiation_roots)
 
     log(output)
     with open(report_path, 'w') as f: